@@ -3,11 +3,30 @@ import base64
 import json
 import openpyxl
 import csv
+import hashlib
+import os
 from io import BytesIO
-import boto3
-from myfunction import process_event  # Import the process_event function
+from clients import get_client
+from myfunnction import process_event, stream_event  # Import the request functions
 import time
 
+# Uploads larger than this go to S3 first and only the s3:// reference is passed on
+UPLOAD_THRESHOLD_BYTES = int(os.environ.get('UPLOAD_THRESHOLD_BYTES', str(5 * 1024 * 1024)))
+UPLOAD_PREFIX = os.environ.get('UPLOAD_PREFIX', 'uploads/')
+
+
+def upload_reference(s3_client, bucket_name, uploaded_file):
+    # Key by content hash so reruns with the same file reuse the object and its parse cache
+    digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()[:32]
+    key = f"{UPLOAD_PREFIX}{digest}/{uploaded_file.name}"
+    uploaded_keys = st.session_state.setdefault('uploaded_keys', set())
+    if key not in uploaded_keys:
+        uploaded_file.seek(0)
+        s3_client.upload_fileobj(uploaded_file, bucket_name, key)
+        uploaded_keys.add(key)
+    return f"s3://{bucket_name}/{key}"
+
+
 def main():
     st.title("Upload File and Enter Prompt")
 
@@ -18,7 +37,7 @@ def main():
     uploaded_file = st.file_uploader("Choose a file", type=['xlsx','csv',])
 
     # S3 Client
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     bucket_name = 'bedrocktest03'
 
     # Get list of files in S3 bucket
@@ -33,6 +52,9 @@ def main():
     # Add "None" option to allow unselecting S3 file
     s3_file_selected = st.selectbox("Select a file from S3 bucket", ["None"] + s3_files)
 
+    # Render the answer token by token as it arrives
+    stream_output = st.checkbox("Stream response", value=True)
+
     # Placeholder for timer
     timer_placeholder = st.empty()
 
@@ -43,35 +65,55 @@ def main():
                 timer_running = True
                 
                 if uploaded_file is not None:
-                    # Read the uploaded file
-                    file_contents = uploaded_file.read()
                     filetype = uploaded_file.type.split('/')[-1]
+                    if uploaded_file.size > UPLOAD_THRESHOLD_BYTES:
+                        # Large files go straight to S3 and are parsed from there
+                        file_contents = upload_reference(s3_client, bucket_name, uploaded_file)
+                    else:
+                        # Read the uploaded file
+                        file_contents = uploaded_file.read()
                     
                 elif s3_file_selected != "None":
-                    # Read the selected S3 file
-                    s3_object = s3_client.get_object(Bucket=bucket_name, Key=s3_file_selected)
-                    file_contents = s3_object['Body'].read()
+                    # Pass a reference; the object is read through the /tmp cache, not downloaded here
+                    file_contents = f"s3://{bucket_name}/{s3_file_selected}"
                     filetype = s3_file_selected.split('.')[-1]
                 else:
                     file_contents = None
                     filetype = ''  # Default filetype when no file is uploaded
 
-                # Process the event using the local function
-                result = process_event(user_prompt, file_contents, filetype)
+                if stream_output:
+                    # Stream the answer into a placeholder as the deltas arrive
+                    st.subheader("Response:")
+                    response_placeholder = st.empty()
+                    stream = stream_event(user_prompt, file_contents, filetype)
+                    for _ in stream:
+                        response_placeholder.markdown(stream.text)
+
+                    # Stop the timer
+                    elapsed_time = time.time() - start_time
+                    timer_running = False
+
+                    # Display time to first token and total time
+                    first_token = stream.metrics['time_to_first_token'] or 0.0
+                    timer_placeholder.write(
+                        f"Time to first token: {first_token:.2f} seconds | Elapsed time: {elapsed_time:.2f} seconds")
+
+                else:
+                    # Process the event using the local function
+                    result = process_event(user_prompt, file_contents, filetype)
 
-                # Stop the timer
-                elapsed_time = time.time() - start_time
-                timer_running = False
+                    # Stop the timer
+                    elapsed_time = time.time() - start_time
+                    timer_running = False
 
-                # Display the generated text
-                st.subheader("Generated Text:")
-                st.write(result.get('generated_text', ''))
-                st.subheader("Response:")
-                st.write(result.get('response', '').get('content', [])[0].get('text', ''))
-            
+                    # Display the generated text
+                    st.subheader("Generated Text:")
+                    st.write(result.get('generated_text', ''))
+                    st.subheader("Response:")
+                    st.write(result.get('response', '').get('content', [])[0].get('text', ''))
 
-                # Display elapsed time
-                timer_placeholder.write(f"Elapsed time: {elapsed_time:.2f} seconds")
+                    # Display elapsed time
+                    timer_placeholder.write(f"Elapsed time: {elapsed_time:.2f} seconds")
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,13 @@
 import json
-import boto3
-import openpyxl
-from io import BytesIO
+from clients import get_client
+from response_cache import cached_invoke
+from prompt_cache import cached_text_block, cache_usage, stats as prompt_cache_stats
+from throttling import default_concurrency
+from table_text import input_budget
+from s3_cache import cached_table_text
+from tracing import traced
 
+@traced('bedrockdoc_handler')
 def lambda_handler(event, context):
     print(event)
     user_prompt=event['prompt']
@@ -24,61 +29,38 @@ def lambda_handler(event, context):
         ]
     })
 
-    # Create an S3 client
-    s3_client = boto3.client('s3')
-
     # S3 bucket and file key details
     bucket_name = 'bedrocktest03'
     file_key = 'Employee_Details-2.xlsx'
 
     try:
-        # Retrieve the file from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_data = s3_object['Body'].read()
-
-        # Read the Excel file
-        excel_file = BytesIO(file_data)
-        workbook = openpyxl.load_workbook(excel_file)
-        sheet = workbook.active
-
-        # Extract information from the Excel file
-        excel_info = []
-        for row in sheet.iter_rows(values_only=True):
-            excel_info.append(list(row))
+        # Retrieve the file through the /tmp cache; unchanged objects skip both download and parse
+        budget = input_budget(request_body.get("max_tokens", 0), user_prompt, event.get('max_input_tokens'))
+        excel_data_text, table_stats = cached_table_text(bucket_name, file_key, 'xlsx', budget, event.get('table_strategy'),
+                                                         table_format=event.get('table_format'),
+                                                         sheets=event.get('sheets'))
 
-        # Convert Excel data to a readable string format
-        excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
+        # Add Excel data ahead of the prompt as a cacheable prefix
+        request_body["messages"][0]["content"].insert(0, cached_text_block(f"Excel file contents:\n{excel_data_text}"))
 
-        # Add Excel data as text to the request body
-        request_body["messages"][0]["content"].append({
-            "type": "text",
-            "text": f"Excel file contents:\n{excel_data_text}"
-        })
-
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
+        # Get the shared Bedrock runtime client (replace with your region)
+        client = get_client('bedrock-runtime', region_name='us-east-1')
 
         # Set the model ID for Claude 3 Sonnet
         model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
-
-        # Parse the payload
-        payload = json.loads(response_payload)
+        # Send the request to Bedrock (identical requests are served from the response cache)
+        payload = cached_invoke(client, model_id, request_body)
+        print("Full Response Payload:", json.dumps(payload))
+        print("Throttling stats:", default_concurrency.snapshot())
+        print("Prompt cache stats:", prompt_cache_stats)
         generated_text = payload.get('completions', [{}])[0].get('text', '')
 
         # Return the generated text
         return {
             'statusCode': 200,
-            'body': json.dumps({'generated_text': generated_text, 'response': payload})
+            'body': json.dumps({'generated_text': generated_text, 'response': payload, 'table_stats': table_stats,
+                                'prompt_cache': cache_usage(payload)})
         }
 
     except Exception as e:
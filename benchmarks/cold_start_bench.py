@@ -0,0 +1,157 @@
+# Cold-start benchmark for the Lambda handler modules.
+# Each run imports a handler module in a fresh interpreter with
+# -X importtime, the way a new Lambda container does during its init
+# phase, and reports the import time per top-level package, the total init
+# duration, and which format libraries were loaded. With --invoke the
+# first request (a small CSV) is timed as well, along with anything it
+# imported. --before measures a second checkout of the repository (e.g. a
+# git worktree of the previous commit) so both trees are reported side by
+# side.
+#
+# Usage: python benchmarks/cold_start_bench.py [--module lambda] [--runs 5] [--invoke]
+#            [--before /path/to/old/checkout] [--top 15] [--output results.json]
+#
+# For --invoke without AWS credentials run with AWS_BACKEND=local LOCAL_LATENCY=fixed:0
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Libraries that only some request formats need
+FORMAT_LIBRARIES = ('openpyxl', 'mammoth', 'pandas', 'pyarrow')
+
+# Runs inside the child interpreter; prints one JSON line with its measurements
+CHILD = r'''
+import base64, importlib, json, sys, time
+start_time = time.perf_counter()
+module = importlib.import_module(sys.argv[1])
+init_seconds = time.perf_counter() - start_time
+sys.stderr.write('-- init done\n')
+sys.stderr.flush()
+result = {'init_seconds': init_seconds, 'loaded': sorted(name for name in sys.modules if '.' not in name)}
+if sys.argv[2] == 'invoke':
+    event = {'prompt': 'How many rows?', 'filetype': 'csv',
+             'file': base64.b64encode(b'id,name\n1,alpha\n2,bravo\n').decode()}
+    start_time = time.perf_counter()
+    module.lambda_handler(event, None)
+    result['first_invoke_seconds'] = time.perf_counter() - start_time
+sys.stdout.write('\n' + json.dumps(result) + '\n')
+'''
+
+
+def parse_importtime(stderr):
+    # Sum the self time (microseconds) of every imported module by top-level package,
+    # separately for the init phase and the first request
+    init, invoke = {}, {}
+    packages = init
+    for line in stderr.splitlines():
+        if line == '-- init done':
+            packages = invoke
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(self_us)
+    return init, invoke
+
+
+def measure(root, module, invoke):
+    # One cold start in a fresh interpreter; logging and printing from the handler are discarded
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD, module, 'invoke' if invoke else 'import'],
+        cwd=root, capture_output=True, text=True,
+        env=dict(os.environ, PYTHONPATH=root))
+    if process.returncode != 0:
+        raise RuntimeError(f"{module} failed to start in {root}:\n{process.stderr.strip().splitlines()[-1]}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    init, invoke = parse_importtime(process.stderr)
+    result['imports_ms'] = {name: us / 1000 for name, us in init.items()}
+    result['invoke_imports_ms'] = {name: us / 1000 for name, us in invoke.items()}
+    return result
+
+
+def summarize(runs):
+    # Medians across runs; cold starts are noisy
+    packages = set().union(*(run['imports_ms'] for run in runs))
+    summary = {
+        'init_seconds': statistics.median(run['init_seconds'] for run in runs),
+        'imports_ms': {name: statistics.median(run['imports_ms'].get(name, 0) for run in runs) for name in packages},
+        'format_libraries': [name for name in FORMAT_LIBRARIES if name in runs[0]['loaded']],
+        'modules_loaded': len(runs[0]['loaded']),
+    }
+    if 'first_invoke_seconds' in runs[0]:
+        summary['first_invoke_seconds'] = statistics.median(run['first_invoke_seconds'] for run in runs)
+        summary['invoke_imports_ms'] = {name: statistics.median(run['invoke_imports_ms'].get(name, 0) for run in runs)
+                                        for name in set().union(*(run['invoke_imports_ms'] for run in runs))}
+    return summary
+
+
+def run(root, module, runs, invoke):
+    # The first run compiles bytecode for the tree and is not counted
+    measure(root, module, invoke)
+    return summarize([measure(root, module, invoke) for _ in range(runs)])
+
+
+def report(results, top):
+    labels = list(results)
+    imports = {}
+    for summary in results.values():
+        for name, ms in summary['imports_ms'].items():
+            imports[name] = max(imports.get(name, 0), ms)
+
+    print(f"{'init import (ms)':<24}" + ''.join(f"{label:>12}" for label in labels))
+    for name in sorted(imports, key=imports.get, reverse=True)[:top]:
+        print(f"{name:<24}" + ''.join(f"{results[label]['imports_ms'].get(name, 0):>12.1f}" for label in labels))
+    print(f"{'total init (ms)':<24}" + ''.join(f"{results[label]['init_seconds'] * 1000:>12.1f}" for label in labels))
+    if all('first_invoke_seconds' in summary for summary in results.values()):
+        print(f"{'first invoke (ms)':<24}" +
+              ''.join(f"{results[label]['first_invoke_seconds'] * 1000:>12.1f}" for label in labels))
+    print(f"{'modules loaded':<24}" + ''.join(f"{results[label]['modules_loaded']:>12}" for label in labels))
+    for label in labels:
+        imported = results[label].get('invoke_imports_ms')
+        if imported:
+            slowest = sorted(imported, key=imported.get, reverse=True)[:5]
+            print(f"{label}: imported by the first request: " +
+                  ', '.join(f"{name} {imported[name]:.1f} ms" for name in slowest))
+        print(f"{label}: format libraries loaded at init: {', '.join(results[label]['format_libraries']) or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold-start benchmark')
+    parser.add_argument('--module', default='lambda', help='handler module to import')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--invoke', action='store_true', help='also time the first request (small CSV)')
+    parser.add_argument('--before', help='another checkout to measure for comparison')
+    parser.add_argument('--top', type=int, default=15, help='number of packages to list')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/cold-start-<time>.json)')
+    args = parser.parse_args()
+
+    results = {}
+    if args.before:
+        results['before'] = run(os.path.abspath(args.before), args.module, args.runs, args.invoke)
+    results['after' if args.before else 'current'] = run(ROOT, args.module, args.runs, args.invoke)
+    report(results, args.top)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"cold-start-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'module': args.module,
+            'results': results,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
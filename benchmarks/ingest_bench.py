@@ -0,0 +1,277 @@
+# Ingestion benchmark: parse, serialize and request-body build times for
+# synthetic spreadsheets across file formats, engines, shapes and sizes.
+# Each case runs in a fresh process so its peak RSS is its own. Results are
+# written as JSON and can be compared against a stored baseline; the exit
+# status is 1 when any case regressed.
+#
+# Usage: python benchmarks/ingest_bench.py [--sizes 1000,10000,...] [--formats xlsx,csv]
+#            [--engines stream,legacy,pandas] [--output results.json]
+#            [--baseline benchmarks/baselines/ingest.json] [--save-baseline]
+#
+# --save-baseline replaces the cases it measured and keeps the rest, so the slow sizes
+# can be recorded on their own. The stored baseline was built with
+#   --sizes 1000,10000,100000 --save-baseline
+#   --sizes 1000000 --engines stream --save-baseline
+# (the full-load engines need tens of GB for a million-row workbook).
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DATA_DIR = os.environ.get('INGEST_BENCH_DATA', '/tmp/ingest-bench')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baselines', 'ingest.json')
+
+# Columns per shape, and the share of text columns per content mix
+SHAPES = {'narrow': 6, 'wide': 60}
+CONTENTS = {'numeric': 0.2, 'text': 0.8}
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+
+# A case regresses when a timing or peak RSS grows by more than this fraction
+TOLERANCE = 0.25
+
+# Timings below this many seconds are too noisy to flag
+MIN_SECONDS = 0.05
+
+
+def synthetic_rows(rows, columns, text_share, seed=11):
+    rng = random.Random(seed)
+    kinds = ['text' if i < round(columns * text_share) else 'number' for i in range(columns)]
+    rng.shuffle(kinds)
+    yield [f'{kind}_{i}' for i, kind in enumerate(kinds)]
+    for _ in range(rows):
+        yield [' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) if kind == 'text'
+               else round(rng.uniform(0, 100000), 2) for kind in kinds]
+
+
+def dataset_path(file_format, shape, content, rows):
+    # Generate the file once and reuse it across runs
+    path = os.path.join(DATA_DIR, f'{shape}-{content}-{rows}.{file_format}')
+    if os.path.exists(path):
+        return path
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp_path = path + '.tmp'
+    data = synthetic_rows(rows, SHAPES[shape], CONTENTS[content])
+    if file_format == 'csv':
+        with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(data)
+    else:
+        import openpyxl
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        for row in data:
+            sheet.append(row)
+        workbook.save(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def peak_rss_mb():
+    # On Linux ru_maxrss survives fork and exec, so a case process would report the
+    # benchmark's own peak (e.g. after generating a large dataset); VmHWM starts afresh
+    try:
+        with open('/proc/self/status', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_case(path, file_format, engine):
+    # Runs in a child process; returns stage timings and the process peak RSS
+    timings = {}
+
+    if engine == 'stream':
+        from ingest import iter_rows
+        from table_text import serialize_row
+
+        # One streaming pass over the file on disk; the clock is split between fetching a
+        # row and serializing it. Lines are counted, not kept, so the peak RSS is that of streaming
+        parse_seconds = serialize_seconds = 0.0
+        rows = 0
+        mark = time.perf_counter()
+        for row in iter_rows(path, file_format):
+            parsed = time.perf_counter()
+            parse_seconds += parsed - mark
+            serialize_row(row)
+            rows += 1
+            mark = time.perf_counter()
+            serialize_seconds += mark - parsed
+        timings['parse_seconds'] = parse_seconds
+        timings['serialize_seconds'] = serialize_seconds
+        parse_rss = peak_rss_mb()
+
+        # The request body the handlers actually build (token budget, default strategy and format);
+        # debug logging of the table text is switched off so it is not part of the timing
+        import logging
+        from myfunnction import build_request_body
+        logging.disable(logging.DEBUG)
+        with open(path, 'rb') as f:
+            data = f.read()
+        start_time = time.perf_counter()
+        build_request_body('Benchmark question', data, file_format)
+        timings['body_seconds'] = time.perf_counter() - start_time
+        timings['body_peak_rss_mb'] = peak_rss_mb()
+
+    elif engine == 'legacy':
+        import io
+        with open(path, 'rb') as f:
+            data = f.read()
+        start_time = time.perf_counter()
+        if file_format == 'xlsx':
+            import openpyxl
+            table = [list(row) for row in openpyxl.load_workbook(io.BytesIO(data)).active.iter_rows(values_only=True)]
+        else:
+            table = list(csv.reader(io.StringIO(data.decode('utf-8'))))
+        timings['parse_seconds'] = time.perf_counter() - start_time
+        rows = len(table)
+
+        start_time = time.perf_counter()
+        "\n".join([", ".join(map(str, row)) for row in table])
+        timings['serialize_seconds'] = time.perf_counter() - start_time
+
+    elif engine == 'pandas':
+        import io
+        import pandas as pd
+        with open(path, 'rb') as f:
+            data = f.read()
+        start_time = time.perf_counter()
+        frame = pd.read_excel(io.BytesIO(data)) if file_format == 'xlsx' else pd.read_csv(io.BytesIO(data))
+        timings['parse_seconds'] = time.perf_counter() - start_time
+        rows = len(frame) + 1
+
+        start_time = time.perf_counter()
+        frame.to_csv(index=False)
+        timings['serialize_seconds'] = time.perf_counter() - start_time
+
+    else:
+        raise ValueError(f'Unknown engine: {engine}')
+
+    # Peak RSS covers parse and serialize only; the body stage also imports the AWS clients
+    seconds = timings['parse_seconds'] + timings['serialize_seconds']
+    return dict(timings, rows_read=rows, rows_per_second=rows / seconds if seconds else None,
+                peak_rss_mb=parse_rss if engine == 'stream' else peak_rss_mb())
+
+
+def case_key(case):
+    return f"{case['format']}/{case['engine']}/{case['shape']}-{case['content']}/{case['rows']}"
+
+
+def run(sizes, formats, engines):
+    results = []
+    context = get_context('spawn')
+    for rows in sizes:
+        for file_format in formats:
+            for shape in SHAPES:
+                for content in CONTENTS:
+                    path = dataset_path(file_format, shape, content, rows)
+                    for engine in engines:
+                        case = {'format': file_format, 'engine': engine, 'shape': shape, 'content': content,
+                                'rows': rows, 'file_bytes': os.path.getsize(path)}
+                        # One process per case so peak RSS is not inherited from earlier cases
+                        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                            try:
+                                case.update(executor.submit(run_case, path, file_format, engine).result())
+                            except ImportError as e:
+                                print(f"skip {case_key(case)}: {e}")
+                                continue
+                            except BrokenProcessPool:
+                                # The child was killed, typically out of memory on a full-load engine
+                                print(f"skip {case_key(case)}: worker process died (out of memory?)", flush=True)
+                                continue
+                        results.append(case)
+                        body = f"{case['body_seconds']:.3f}s" if 'body_seconds' in case else '-'
+                        print(f"{case_key(case):<40} parse={case['parse_seconds']:.3f}s "
+                              f"serialize={case['serialize_seconds']:.3f}s body={body} "
+                              f"rows/s={case['rows_per_second'] or 0:,.0f} rss={case['peak_rss_mb']:.0f} MB", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Return regression messages for cases slower or bigger than the baseline
+    previous = {case_key(case): case for case in baseline['results']}
+    regressions = []
+    for case in results:
+        old = previous.get(case_key(case))
+        if old is None:
+            continue
+        for metric in ('parse_seconds', 'serialize_seconds', 'body_seconds', 'peak_rss_mb'):
+            if metric not in case or metric not in old:
+                continue
+            if metric.endswith('seconds') and case[metric] < MIN_SECONDS:
+                continue
+            if case[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{case_key(case)} {metric}: {old[metric]:.3f} -> {case[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ingestion benchmark')
+    parser.add_argument('--sizes', default='1000,10000', help='row counts, e.g. 1000,10000,100000,1000000')
+    parser.add_argument('--formats', default='xlsx,csv')
+    parser.add_argument('--engines', default='stream,legacy,pandas')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/ingest-<time>.json)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run([int(size) for size in args.sizes.split(',')], args.formats.split(','), args.engines.split(','))
+    report = {
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"ingest-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.save_baseline:
+        # Cases from earlier runs that this run did not cover are kept, so the slow
+        # large sizes can be recorded separately from the small ones
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                previous = json.load(f)['results']
+            measured = {case_key(case) for case in results}
+            report['results'] = [case for case in previous if case_key(case) not in measured] + results
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against (run with --save-baseline)")
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regression(s) against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+# Compare the plain and compact table encodings on synthetic employee data.
+# Reports bytes and estimated tokens per row for each format.
+#
+# Usage: python benchmarks/table_encoding_bench.py [rows] [file.xlsx|file.csv]
+
+import datetime
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ingest import iter_rows
+from table_text import CompactEncoder, build_table_text, estimate_tokens
+
+DEPARTMENTS = ['Engineering', 'Human Resources', 'Sales and Marketing', 'Finance', 'Customer Support']
+LOCATIONS = ['Bengaluru', 'Chennai', 'Hyderabad', 'Pune']
+
+
+def synthetic_rows(count, seed=7):
+    rng = random.Random(seed)
+    yield ('Employee ID', 'Name', 'Department', 'Location', 'Salary', 'Rating', 'Joined', 'Manager')
+    for i in range(count):
+        yield (
+            1000 + i,
+            f'Employee {i}',
+            rng.choice(DEPARTMENTS),
+            rng.choice(LOCATIONS),
+            round(rng.uniform(30000, 150000), 2),
+            rng.random() * 5,
+            datetime.datetime(2015, 1, 1) + datetime.timedelta(days=rng.randrange(3000)),
+            None if rng.random() < 0.6 else f'Employee {rng.randrange(count)}',
+        )
+
+
+def measure(rows_factory, label):
+    # No budget here: the whole table is encoded so the sizes are comparable
+    budget = 10 ** 9
+    plain_text, stats = build_table_text(rows_factory(), budget, 'truncate')
+    encoder, rows = CompactEncoder.from_rows(rows_factory())
+    compact_text, _ = build_table_text(rows, budget, 'truncate', serialize=encoder)
+
+    count = max(1, stats['rows_included'] - 1)
+    print(f"{label}: {count} rows")
+    print(f"{'format':<10}{'bytes/row':>12}{'tokens/row':>12}{'total tokens':>14}")
+    for name, text in (('plain', plain_text), ('compact', compact_text)):
+        size = len(text.encode('utf-8'))
+        tokens = estimate_tokens(text)
+        print(f"{name:<10}{size / count:>12.1f}{tokens / count:>12.1f}{tokens:>14}")
+    saved = 1 - estimate_tokens(compact_text) / max(1, estimate_tokens(plain_text))
+    print(f"compact saves {saved:.0%} of estimated input tokens")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+        with open(path, 'rb') as f:
+            data = f.read()
+        filetype = path.rsplit('.', 1)[-1]
+        measure(lambda: iter_rows(data, filetype), path)
+    else:
+        count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+        measure(lambda: synthetic_rows(count), 'synthetic')
@@ -1,7 +1,26 @@
 import json
-import boto3
-import base64
+import os
+from clients import get_client
+from response_cache import cached_invoke
+from throttling import default_concurrency
+from images import s3_image_blocks, stats as image_stats
+from tracing import traced, span
 
+DEFAULT_BUCKET = 'bedrocktest02'
+DEFAULT_IMAGE_KEYS = ['testimage.png']
+
+# "bucket" and "image_keys" may only name the default image or objects under IMAGE_PREFIX in
+# IMAGE_BUCKET, so a caller cannot read other objects the Lambda role has access to
+IMAGE_BUCKET = os.environ.get('IMAGE_BUCKET', DEFAULT_BUCKET)
+IMAGE_PREFIX = os.environ.get('IMAGE_PREFIX', 'images/')
+
+
+def allowed_image(bucket, key):
+    if bucket == DEFAULT_BUCKET and key in DEFAULT_IMAGE_KEYS:
+        return True
+    return bucket == IMAGE_BUCKET and key.startswith(IMAGE_PREFIX)
+
+@traced('claude_image_handler')
 def lambda_handler(event, context):
     # Extract request body from the event
     request_body = event.get('body', {
@@ -20,55 +39,59 @@ def lambda_handler(event, context):
         ]
     })
 
-    # Create an S3 client
-    s3_client = boto3.client('s3')
+    # Get the shared S3 client
+    s3_client = get_client('s3')
 
-    # S3 bucket and image key details
-    bucket_name = 'bedrocktest02'
-    image_key = 'testimage.png'
+    # S3 bucket and image key details (several images are fetched in parallel)
+    bucket_name = event.get('bucket', DEFAULT_BUCKET)
+    image_keys = event.get('image_keys', DEFAULT_IMAGE_KEYS)
+    if not (isinstance(bucket_name, str) and isinstance(image_keys, list)
+            and all(isinstance(key, str) and key for key in image_keys)):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': 'bucket must be a string and image_keys a list of object keys'})
+        }
+    denied = [key for key in image_keys if not allowed_image(bucket_name, key)]
+    if denied:
+        return {
+            'statusCode': 403,
+            'body': json.dumps({'error': f"Image keys not allowed: {', '.join(f's3://{bucket_name}/{key}' for key in denied)}"})
+        }
 
     try:
-        # Retrieve the image from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=image_key)
-        image_data = s3_object['Body'].read()
+        # Retrieve the images from S3, downscaled and re-encoded (cached by content hash)
+        with span('images'):
+            images = s3_image_blocks(bucket_name, image_keys, s3_client)
 
-        # Encode the image data to base64
-        encoded_image_data = base64.b64encode(image_data).decode('utf-8')
+        # Add the images to the request body with their real media types
+        for block, _ in images:
+            request_body["messages"][0]["content"].append(block)
 
-        # Add image data to the request body
-        request_body["messages"][0]["content"].append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/png",
-                "data": encoded_image_data
-            }
-        })
-
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
+        # Get the shared Bedrock runtime client (replace with your region)
+        client = get_client('bedrock-runtime', region_name='us-east-1')
 
         # Set the model ID for Claude 3 Sonnet
         model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
-
-        # Parse the payload
-        payload = json.loads(response_payload)
+        # Send the request to Bedrock (identical requests are served from the response cache)
+        payload = cached_invoke(client, model_id, request_body)
+        print("Full Response Payload:", json.dumps(payload))
+        print("Throttling stats:", default_concurrency.snapshot())
+        print("Image stats:", image_stats)
         generated_text = payload.get('completions', [{}])[0].get('text', '')
 
         # Return the generated text
         return {
             'statusCode': 200,
-            'body': json.dumps({'generated_text': generated_text, 'response': payload})
+            'body': json.dumps({'generated_text': generated_text, 'response': payload,
+                                'images': [info for _, info in images]})
+        }
+
+    except ValueError as e:
+        # An object that is not a supported, readable image
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': str(e)})
         }
 
     except Exception as e:
@@ -0,0 +1,74 @@
+# Shared boto3 client registry, created once per process so warm Lambda
+# containers and Streamlit reruns reuse pooled connections.
+
+import os
+import threading
+import boto3
+from botocore.config import Config
+
+# Default region used by the handlers
+DEFAULT_REGION = os.environ.get('BEDROCK_REGION') or os.environ.get('AWS_REGION', 'us-east-1')
+
+# Connection settings (override with environment variables)
+MAX_POOL_CONNECTIONS = int(os.environ.get('CLIENT_MAX_POOL_CONNECTIONS', '20'))
+CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.environ.get('CLIENT_READ_TIMEOUT', '120'))
+TCP_KEEPALIVE = os.environ.get('CLIENT_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# Total botocore attempts per call, first try included (1 = no botocore retries).
+# bedrock-runtime makes a single attempt by default so every throttle reaches
+# throttling.call_with_retry and its adaptive window instead of being retried
+# underneath it; other services keep botocore's default. CLIENT_MAX_ATTEMPTS
+# overrides both.
+MAX_ATTEMPTS = os.environ.get('CLIENT_MAX_ATTEMPTS')
+SERVICE_MAX_ATTEMPTS = {'bedrock-runtime': 1}
+
+# aws: real boto3 clients; local: the stand-ins in local_aws.py for bedrock-runtime and s3
+BACKEND = os.environ.get('AWS_BACKEND', 'aws').lower()
+LOCAL_SERVICES = ('bedrock-runtime', 's3')
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service, region_name=None, max_pool_connections=None,
+               connect_timeout=None, read_timeout=None, tcp_keepalive=None):
+    # Fill in defaults for anything not given
+    region_name = region_name or DEFAULT_REGION
+    options = (
+        max_pool_connections or MAX_POOL_CONNECTIONS,
+        connect_timeout or CONNECT_TIMEOUT,
+        read_timeout or READ_TIMEOUT,
+        TCP_KEEPALIVE if tcp_keepalive is None else tcp_keepalive,
+    )
+    key = (service, region_name) + options
+
+    # Return the cached client if one exists for this service, region and config
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            if BACKEND == 'local' and service in LOCAL_SERVICES:
+                from local_aws import local_client
+                _clients[key] = local_client(service)
+                return _clients[key]
+            max_attempts = int(MAX_ATTEMPTS) if MAX_ATTEMPTS else SERVICE_MAX_ATTEMPTS.get(service)
+            config = Config(
+                max_pool_connections=options[0],
+                connect_timeout=options[1],
+                read_timeout=options[2],
+                tcp_keepalive=options[3],
+                retries={'total_max_attempts': max_attempts} if max_attempts else None,
+            )
+            client = boto3.client(service, region_name=region_name, config=config)
+            _clients[key] = client
+    return client
+
+
+def clear_clients():
+    # Drop all cached clients (e.g. after changing credentials)
+    with _lock:
+        _clients.clear()
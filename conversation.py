@@ -0,0 +1,92 @@
+# Bounded multi-turn history for chat front ends.
+# Recent turns are resent verbatim up to a token window; when the window is
+# exceeded the oldest turns are folded into a running summary by a small,
+# fast model. The request size (and so the per-turn latency) stays flat as
+# the conversation grows: cached file prefix + summary + window + question.
+
+import logging
+import os
+
+from prompt_cache import CACHE_CONTROL
+from response_cache import cached_invoke, message_body, response_text
+from table_text import estimate_tokens
+
+# Tokens of recent turns resent verbatim; compaction brings history back down to
+# COMPACT_TO of the window so it runs every few turns rather than on every turn
+HISTORY_TOKENS = int(os.environ.get('HISTORY_TOKENS', '3000'))
+COMPACT_TO = float(os.environ.get('HISTORY_COMPACT_TO', '0.5'))
+
+SUMMARY_TOKENS = int(os.environ.get('HISTORY_SUMMARY_TOKENS', '400'))
+SUMMARY_MODEL_ID = os.environ.get('HISTORY_SUMMARY_MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+
+SUMMARY_INSTRUCTIONS = (
+    "Update the running summary of a conversation about a data file with the turns below. "
+    "Keep every fact, number, filter and decision the user may refer back to, and drop small talk. "
+    f"Reply with the updated summary only, in at most {SUMMARY_TOKENS * 3 // 4} words."
+)
+
+
+class Conversation:
+
+    def __init__(self, history_tokens=HISTORY_TOKENS):
+        self.history_tokens = history_tokens
+        self.turns = []  # (question, answer) pairs resent verbatim
+        self.summary = ''
+        self.summarized_turns = 0
+
+    def summary_blocks(self):
+        # System blocks for the running summary; they follow the cached file prefix
+        if not self.summary:
+            return []
+        return [{"type": "text", "text": f"Summary of the earlier conversation:\n{self.summary}"}]
+
+    def messages(self, question):
+        # Recent turns plus the new question; the last answer ends a cache checkpoint
+        # so the unchanged history is read from the prompt cache on the next turn
+        messages = []
+        for i, (past_question, answer) in enumerate(self.turns):
+            answer_block = {"type": "text", "text": answer}
+            if i == len(self.turns) - 1:
+                answer_block["cache_control"] = CACHE_CONTROL
+            messages.append({"role": "user", "content": [{"type": "text", "text": past_question}]})
+            messages.append({"role": "assistant", "content": [answer_block]})
+        messages.append({"role": "user", "content": [{"type": "text", "text": question}]})
+        return messages
+
+    def add_turn(self, question, answer):
+        self.turns.append((question, answer))
+
+    def history_size(self):
+        return sum(estimate_tokens(question) + estimate_tokens(answer) for question, answer in self.turns)
+
+    def needs_compaction(self):
+        return self.history_size() > self.history_tokens
+
+    def compact(self, client, model_id=SUMMARY_MODEL_ID):
+        # Fold the oldest turns into the summary until history fits COMPACT_TO of the window.
+        # Call after the answer is shown so the user does not wait for it
+        if not self.needs_compaction():
+            return False
+        target = self.history_tokens * COMPACT_TO
+        folded = []
+        while self.turns and (self.history_size() > target or not folded):
+            folded.append(self.turns.pop(0))
+
+        transcript = "\n\n".join(f"User: {question}\nAssistant: {answer}" for question, answer in folded)
+        text = f"{SUMMARY_INSTRUCTIONS}\n\nCurrent summary:\n{self.summary or '(none)'}\n\nTurns:\n{transcript}"
+        try:
+            self.summary = response_text(cached_invoke(client, model_id, message_body(text, SUMMARY_TOKENS))).strip()
+        except Exception as e:
+            # Keep going without the folded turns rather than failing the chat
+            logging.error(f"History compaction failed: {e}")
+        self.summarized_turns += len(folded)
+        logging.debug(f"Compacted {len(folded)} turns: {self.stats()}")
+        return True
+
+    def stats(self):
+        return {
+            'turns': len(self.turns),
+            'summarized_turns': self.summarized_turns,
+            'history_tokens': self.history_size(),
+            'summary_tokens': estimate_tokens(self.summary),
+        }
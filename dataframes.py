@@ -0,0 +1,104 @@
+# DataFrame loading and preview for the Streamlit apps.
+# CSV uploads are parsed by the multi-threaded pyarrow engine into
+# Arrow-backed columns (compact strings, nullable types) when pyarrow is
+# installed, and in row chunks by the C engine otherwise or when a row cap
+# is set. The preview sends one page of rows to the browser instead of the
+# whole table.
+
+import importlib.util
+import logging
+import math
+import os
+import time
+from io import BytesIO
+
+import pandas as pd
+
+from ingest import is_excel
+
+ARROW = importlib.util.find_spec('pyarrow') is not None
+
+# Rows per chunk for chunked reading, and a cap on loaded rows (0 = no cap)
+CHUNK_ROWS = int(os.environ.get('LOAD_CHUNK_ROWS', '200000'))
+MAX_ROWS = int(os.environ.get('LOAD_MAX_ROWS', '0'))
+
+PAGE_SIZE = int(os.environ.get('PREVIEW_PAGE_SIZE', '100'))
+
+
+def _backend():
+    return {'dtype_backend': 'pyarrow'} if ARROW else {}
+
+
+def iter_frames(file_data, filetype, chunk_rows=CHUNK_ROWS):
+    # DataFrame chunks of at most chunk_rows rows (a workbook is read as one chunk)
+    if is_excel(filetype):
+        yield pd.read_excel(BytesIO(file_data), **_backend())
+        return
+    with pd.read_csv(BytesIO(file_data), chunksize=chunk_rows, **_backend()) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def load_dataframe(file_data, filetype, max_rows=MAX_ROWS):
+    # Return (dataframe, stats) with load time, memory and the engine used
+    start_time = time.perf_counter()
+    dataframe, engine, truncated = None, None, False
+
+    if is_excel(filetype):
+        dataframe = pd.read_excel(BytesIO(file_data), nrows=max_rows or None, **_backend())
+        engine = 'openpyxl'
+        truncated = bool(max_rows) and len(dataframe) >= max_rows
+    elif ARROW and not max_rows:
+        try:
+            dataframe = pd.read_csv(BytesIO(file_data), engine='pyarrow', dtype_backend='pyarrow')
+            engine = 'pyarrow'
+        except Exception as e:
+            # e.g. a column whose type changes after the first block; the chunked reader copes
+            logging.debug(f"pyarrow CSV engine failed, reading in chunks: {e}")
+
+    if dataframe is None:
+        chunks, rows = [], 0
+        frames = iter_frames(file_data, filetype)
+        for chunk in frames:
+            if max_rows and rows + len(chunk) >= max_rows:
+                chunks.append(chunk.iloc[:max_rows - rows])
+                truncated = rows + len(chunk) > max_rows or next(frames, None) is not None
+                break
+            chunks.append(chunk)
+            rows += len(chunk)
+        frames.close()
+        dataframe = pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+        engine = f"chunked{' (arrow dtypes)' if ARROW else ''}"
+
+    stats = {
+        'rows': len(dataframe),
+        'columns': len(dataframe.columns),
+        'memory_mb': float(dataframe.memory_usage(deep=True).sum()) / (1024 * 1024),
+        'load_seconds': time.perf_counter() - start_time,
+        'engine': engine,
+        'truncated': truncated,
+    }
+    logging.debug(f"Loaded DataFrame: {stats}")
+    return dataframe, stats
+
+
+def render_preview(dataframe, stats=None, key='preview', page_size=PAGE_SIZE):
+    # Show one page of rows with memory and render time; only that page is sent to the browser
+    import streamlit as st
+
+    pages = max(1, math.ceil(len(dataframe) / page_size))
+    page = st.number_input(f"Page (of {pages:,})", min_value=1, max_value=pages, value=1, key=f'{key}_page')
+    start = (page - 1) * page_size
+    end = min(start + page_size, len(dataframe))
+
+    start_time = time.perf_counter()
+    st.dataframe(dataframe.iloc[start:end])
+    render_ms = (time.perf_counter() - start_time) * 1000
+
+    caption = f"Rows {start + 1:,}-{end:,} of {len(dataframe):,}" if len(dataframe) else "No rows"
+    if stats:
+        if stats['truncated']:
+            caption += f" (first {stats['rows']:,} rows loaded)"
+        caption += (f" | {stats['memory_mb']:.1f} MB in memory ({stats['engine']})"
+                    f" | loaded in {stats['load_seconds']:.2f}s")
+    st.caption(f"{caption} | page rendered in {render_ms:.0f} ms")
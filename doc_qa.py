@@ -0,0 +1,151 @@
+# Document question answering with passage retrieval.
+# The document is split into passages and indexed locally (BM25); each
+# question only sends its best matching passages to the model for quote
+# extraction, and those calls run in parallel. A final call answers from
+# the numbered quotes, so cost no longer grows with the document length.
+
+import hashlib
+import logging
+import os
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from row_index import RowIndex, cached_index, tokenize
+from table_text import estimate_tokens
+from prompt_cache import prefix_blocks, prepare_blocks, record
+from throttling import call_with_retry
+
+# Passage size and the number of passages sent per question
+PASSAGE_TOKENS = int(os.environ.get('DOC_QA_PASSAGE_TOKENS', '400'))
+TOP_PASSAGES = int(os.environ.get('DOC_QA_TOP_PASSAGES', '4'))
+MAX_WORKERS = int(os.environ.get('DOC_QA_WORKERS', '8'))
+
+NO_QUOTES = 'No relevant quotes'
+
+QUOTE_INSTRUCTIONS = (
+    "I'm going to give you a passage from a document and a question about the document. "
+    "Write down exact quotes from the passage that would help answer the question, one per line, "
+    "each in double quotes. Quotes should be relatively short. "
+    f"If there are no relevant quotes, write \"{NO_QUOTES}\" instead."
+)
+
+ANSWER_INSTRUCTIONS = (
+    "Answer the question using facts from the numbered quotes below, starting with \"Answer:\". "
+    "Do not include or reference quoted content verbatim in the answer. Don't say \"According to Quote [1]\" "
+    "when answering. Instead make references to quotes relevant to each section of the answer solely by "
+    "adding their bracketed numbers at the end of relevant sentences. If the question cannot be answered "
+    "by the quotes, say so. Answer the question immediately without preamble."
+)
+
+
+def split_passages(text, passage_tokens=PASSAGE_TOKENS):
+    # Group whole paragraphs into passages of about passage_tokens
+    passages, current, tokens = [], [], 0
+    for paragraph in (line.strip() for line in text.splitlines()):
+        if not paragraph:
+            continue
+        paragraph_tokens = estimate_tokens(paragraph) + 1
+        if current and tokens + paragraph_tokens > passage_tokens:
+            passages.append("\n".join(current))
+            current, tokens = [], 0
+        current.append(paragraph)
+        tokens += paragraph_tokens
+    if current:
+        passages.append("\n".join(current))
+    return passages
+
+
+def build_passage_index(passages):
+    # Same BM25 scoring as table rows, with each passage as one document
+    postings, lengths = {}, []
+    for number, passage in enumerate(passages):
+        weights = Counter(tokenize(passage))
+        for term, weight in weights.items():
+            postings.setdefault(term, []).append([number, weight])
+        lengths.append(sum(weights.values()))
+    return RowIndex('', passages, postings, lengths)
+
+
+def passage_index(document, passage_tokens=PASSAGE_TOKENS):
+    # Indexes are cached by document hash, so repeated questions skip the split
+    digest = hashlib.sha256(document.encode('utf-8')).hexdigest()
+    return cached_index(('passages', digest, passage_tokens),
+                        lambda: build_passage_index(split_passages(document, passage_tokens)))
+
+
+def converse_text(client, model_id, content, max_tokens):
+    # content is a list of converse blocks; cache points are dropped for models without prompt caching
+    response = call_with_retry(lambda: client.converse(
+        modelId=model_id,
+        messages=[{"role": "user", "content": prepare_blocks(model_id, content)}],
+        inferenceConfig={"maxTokens": max_tokens, "temperature": 0},
+    ))
+    record(response)
+    return response["output"]["message"]["content"][0]["text"]
+
+
+def _normalize(text):
+    return " ".join(text.split())
+
+
+def parse_quotes(text, passage):
+    # Keep only quotes that appear verbatim in the passage
+    passage = _normalize(passage)
+    quotes = []
+    for line in text.splitlines():
+        quote = re.sub(r'^\s*(?:[-*•]|\[\d+\]|\d+[.)])\s*', '', line).strip().strip('"“”').strip()
+        if quote and quote != NO_QUOTES and _normalize(quote) in passage and quote not in quotes:
+            quotes.append(quote)
+    return quotes
+
+
+def answer_questions(client, model_id, document, questions, top_passages=None, max_tokens=2000,
+                     max_workers=None):
+    # Return one result per question: the numbered-quote answer text plus the quotes and timings
+    start_time = time.perf_counter()
+    index = passage_index(document)
+    top_passages = TOP_PASSAGES if top_passages is None else top_passages
+    candidates = [sorted(number for number, _ in index.search(question, top_passages)) for question in questions]
+
+    def extract(job):
+        question, number = job
+        passage = index.lines[number]
+        # Instructions and passage are shared by every question that retrieves it; they are
+        # only cached when long enough (the default passages and answer instructions are not)
+        content = prefix_blocks(model_id, f"{QUOTE_INSTRUCTIONS}\n\n<passage>\n{passage}\n</passage>")
+        content.append({"text": f"Question: {question}"})
+        return parse_quotes(converse_text(client, model_id, content, 500), passage)
+
+    jobs = [(question, number) for question, numbers in zip(questions, candidates) for number in numbers]
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS) as executor:
+        extracted = dict(zip(jobs, executor.map(extract, jobs)))
+        extract_time = time.perf_counter() - start_time
+
+        def answer(position):
+            question = questions[position]
+            # Quotes are numbered in document order
+            quotes = [quote for number in candidates[position] for quote in extracted[(question, number)]]
+            if not quotes:
+                text = f"Relevant quotes:\n{NO_QUOTES}\n\nAnswer: \nThe question cannot be answered by the document."
+            else:
+                numbered = "\n".join(f'[{i + 1}] "{quote}"' for i, quote in enumerate(quotes))
+                content = prefix_blocks(model_id, ANSWER_INSTRUCTIONS)
+                content.append({"text": f"<quotes>\n{numbered}\n</quotes>\n\nQuestion: {question}"})
+                text = f"Relevant quotes:\n{numbered}\n\n{converse_text(client, model_id, content, max_tokens).strip()}"
+            return {
+                'question': question,
+                'text': text,
+                'quotes': quotes,
+                'passages': candidates[position],
+            }
+
+        results = list(executor.map(answer, range(len(questions))))
+
+    total_time = time.perf_counter() - start_time
+    logging.debug(f"Doc QA: {len(index.lines)} passages, {len(jobs)} extraction calls, "
+                  f"extract={extract_time:.2f}s total={total_time:.2f}s")
+    for result in results:
+        result['timings'] = {'extract_seconds': extract_time, 'total_seconds': total_time}
+    return results
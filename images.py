@@ -0,0 +1,186 @@
+# Image preprocessing for vision requests.
+# Images are sniffed for their real format, downscaled to the largest size
+# the model makes use of (Claude resizes anything bigger itself, so extra
+# pixels only add upload time), re-encoded to a smaller format, and cached
+# by content hash. Pillow is optional: without it images are passed through
+# unchanged with their sniffed media type.
+
+import base64
+import hashlib
+import io
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_cache import read_object
+from tracing import span, bind
+
+# Claude's useful maximum: about 1568 px on the long edge and 1.15 megapixels
+MAX_EDGE = int(os.environ.get('IMAGE_MAX_EDGE', '1568'))
+MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', '1150000'))
+
+# Output format: webp (lossless for PNG/GIF sources, which are usually screenshots and
+# diagrams), jpeg (png for images with transparency) or keep
+OUTPUT_FORMAT = os.environ.get('IMAGE_FORMAT', 'webp').lower()
+QUALITY = int(os.environ.get('IMAGE_QUALITY', '85'))
+
+# Prepared images kept in memory, and parallel S3 fetches per request
+MAX_CACHED = int(os.environ.get('IMAGE_CACHE_SIZE', '32'))
+FETCH_WORKERS = int(os.environ.get('IMAGE_FETCH_WORKERS', '8'))
+
+MEDIA_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+stats = {'prepared': 0, 'cache_hits': 0, 'resized': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def sniff_format(data):
+    # Image format from the file signature, or None if it is not a supported image
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def target_size(width, height, max_edge=MAX_EDGE, max_pixels=MAX_PIXELS):
+    # Largest size within both limits, keeping the aspect ratio
+    scale = min(1.0, max_edge / max(width, height), (max_pixels / (width * height)) ** 0.5)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def estimate_image_tokens(width, height):
+    # Claude bills about one token per 750 pixels
+    return round(width * height / 750)
+
+
+def _reencode(data, image_format):
+    # Return (format, bytes, width, height, resized); the original bytes when re-encoding does not pay off
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return image_format, data, None, None, False
+
+    image = Image.open(io.BytesIO(data))
+    if getattr(image, 'is_animated', False):
+        # Keep animations as they are
+        return image_format, data, image.width, image.height, False
+    image = ImageOps.exif_transpose(image)
+    size = target_size(image.width, image.height)
+    resized = size != (image.width, image.height)
+    if resized:
+        image = image.resize(size, Image.LANCZOS)
+
+    output_format = image_format if OUTPUT_FORMAT == 'keep' else OUTPUT_FORMAT
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or (image.mode == 'P' and 'transparency' in image.info)
+    if output_format == 'jpeg' and has_alpha:
+        output_format = 'png'
+    if output_format == 'jpeg' and image.mode != 'RGB':
+        image = image.convert('RGB')
+    elif output_format in ('webp', 'png') and image.mode not in ('RGB', 'RGBA', 'L', 'LA', 'P'):
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    buffer = io.BytesIO()
+    if output_format == 'png':
+        image.save(buffer, 'PNG', optimize=True)
+    elif output_format == 'webp' and image_format in ('png', 'gif'):
+        image.save(buffer, 'WEBP', lossless=True)
+    else:
+        image.save(buffer, output_format.upper(), quality=QUALITY)
+    encoded = buffer.getvalue()
+    if not resized and len(encoded) >= len(data):
+        return image_format, data, image.width, image.height, False
+    return output_format, encoded, image.width, image.height, resized
+
+
+def _image_errors():
+    # Exceptions Pillow raises for corrupt, truncated or oversized images (older
+    # plugins still raise SyntaxError for broken files)
+    try:
+        from PIL import Image
+    except ImportError:
+        return (OSError,)
+    return (OSError, SyntaxError, Image.DecompressionBombError)
+
+
+def prepare_image(data):
+    # Return (media type, image bytes, info) ready for a request, cached by content hash
+    image_format = sniff_format(data)
+    if image_format is None:
+        raise ValueError('Unsupported image format (expected PNG, JPEG, GIF or WebP)')
+    cache_key = hashlib.sha256(data)
+    cache_key.update(f'{MAX_EDGE}:{MAX_PIXELS}:{OUTPUT_FORMAT}:{QUALITY}'.encode('utf-8'))
+    cache_key = cache_key.hexdigest()
+
+    with _lock:
+        cached = _cache.get(cache_key)
+        if cached is not None:
+            _cache.move_to_end(cache_key)
+            stats['cache_hits'] += 1
+            return cached
+
+    with span('image_prepare'):
+        try:
+            output_format, encoded, width, height, resized = _reencode(data, image_format)
+        except _image_errors() as e:
+            raise ValueError(f'Invalid {image_format} image: {e}') from e
+    info = {
+        'source_format': image_format,
+        'format': output_format,
+        'bytes_in': len(data),
+        'bytes_out': len(encoded),
+        'width': width,
+        'height': height,
+        'resized': resized,
+        'estimated_tokens': estimate_image_tokens(width, height) if width else None,
+    }
+    logging.debug(f"Prepared image: {info}")
+    prepared = (MEDIA_TYPES[output_format], encoded, info)
+
+    with _lock:
+        stats['prepared'] += 1
+        stats['resized'] += resized
+        stats['bytes_in'] += len(data)
+        stats['bytes_out'] += len(encoded)
+        _cache[cache_key] = prepared
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return prepared
+
+
+def image_block(data):
+    # Messages API image block for raw image bytes, and the preparation info
+    media_type, encoded, info = prepare_image(data)
+    return {
+        "type": "image",
+        "source": {
+            "type": "base64",
+            "media_type": media_type,
+            "data": base64.b64encode(encoded).decode('utf-8')
+        }
+    }, info
+
+
+def s3_image_blocks(bucket, keys, client=None, max_workers=FETCH_WORKERS):
+    # (block, info) for several S3 objects, fetched and prepared in parallel, in key order.
+    # Objects go through the /tmp cache, so unchanged images are not downloaded again
+    def load(key):
+        return image_block(read_object(bucket, key, client))
+
+    if len(keys) <= 1:
+        return [load(key) for key in keys]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(keys))) as executor:
+        return list(executor.map(bind(load), keys))
+
+
+def clear_images():
+    with _lock:
+        _cache.clear()
@@ -1,10 +1,15 @@
 import json
-import boto3
+import base64
+from clients import get_client
+from response_cache import cached_invoke
+from images import image_block
+from tracing import traced
 
+@traced('image_prompt_handler')
 def lambda_handler(event, context):
     # Extract user prompt and (optional) image data from the event object
     user_prompt = event.get('prompt', None)
-    image_data = event.get('image_data', None)
+    image_data = event.get('image_data', None)  # Base64 image, or a list of them
 
     # Construct the request body for Bedrock API
     request_body = {
@@ -22,33 +27,34 @@ def lambda_handler(event, context):
             }
         ]
     }
-    # If image data is provided, include it in the request
+    # If image data is provided, include it in the request, downscaled and with its real media type
+    images = []
     if image_data:
-        request_body["messages"][0]["content"].append({
-            "type": "image",
-            "source": {
-                "type": "base64",
-                "media_type": "image/jpeg",
-                "data": image_data
-            }
-        })
+        for data in image_data if isinstance(image_data, list) else [image_data]:
+            try:
+                block, info = image_block(base64.b64decode(data))
+            except ValueError as e:
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': str(e)})
+                }
+            request_body["messages"][0]["content"].append(block)
+            images.append(info)
 
-    # Create a Bedrock runtime client (replace with your region)
-    client = boto3.client('bedrock-runtime', region_name='us-east-1')
+    # Get the shared Bedrock runtime client (replace with your region)
+    client = get_client('bedrock-runtime', region_name='us-east-1')
 
     # Set the model ID for Claude 3.5 Sonnet
     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 
-    # Send the request to Bedrock using the 'invoke' API method
-    response = client.invoke_model(
-        modelId=model_id,
-        body=json.dumps(request_body)
-    )
+    # Send the request to Bedrock (identical requests are served from the response cache)
+    payload = cached_invoke(client, model_id, request_body)
+
     # Extract the generated response from the payload
-    generated_text = response['payload'].get('completions', [{}])[0].get('text', '')
+    generated_text = payload.get('completions', [{}])[0].get('text', '')
 
     # Return the generated text
     return {
         'statusCode': 200,
-        'body': json.dumps({'generated_text': generated_text})
+        'body': json.dumps({'generated_text': generated_text, 'images': images})
     }
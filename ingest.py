@@ -0,0 +1,302 @@
+# Streaming spreadsheet ingestion.
+# Rows are read lazily (openpyxl read-only mode, csv reader over a text
+# stream) and serialized one at a time, so the whole workbook is never
+# materialized in memory.
+
+import csv
+import importlib
+import io
+import logging
+import os
+import posixpath
+import re
+import sys
+import time
+import tracemalloc
+import zipfile
+from io import BytesIO
+from xml.etree import ElementTree
+
+# File types handled as Excel workbooks
+EXCEL_TYPES = ['xlsx', 'xls', 'vnd.openxmlformats-officedocument.spreadsheetml.sheet']
+
+# Parser library for each format, imported on first use (see preload)
+FORMAT_MODULES = {filetype: 'openpyxl' for filetype in EXCEL_TYPES}
+
+# Caps on the rows read from any file, header included (0 means unlimited);
+# every handler path reads rows through iter_rows / iter_xlsx_sheets
+MAX_ROWS = int(os.environ.get('INGEST_MAX_ROWS', '0'))
+MAX_BYTES = int(os.environ.get('INGEST_MAX_BYTES', '0'))
+
+
+def is_excel(filetype):
+    return (filetype or '').lower() in EXCEL_TYPES
+
+
+def is_csv(filetype):
+    return (filetype or '').lower() == 'csv'
+
+
+def preload(formats):
+    # Import the parser libraries for formats now instead of on the first request
+    # that needs them (e.g. during a provisioned-concurrency init phase)
+    for filetype in formats:
+        module = FORMAT_MODULES.get(filetype.strip().lower())
+        if module:
+            importlib.import_module(module)
+
+
+def _open(file_data):
+    # file_data is the raw bytes or the path of a local copy (e.g. an S3 object cached
+    # on /tmp), which the parsers read lazily without loading the whole file
+    if isinstance(file_data, (bytes, bytearray)):
+        return BytesIO(file_data)
+    return open(file_data, 'rb')
+
+
+def _load_workbook(source):
+    # read_only streams rows from the sheet XML instead of building every cell.
+    # A file that is not a workbook is invalid input (ValueError), not a server error
+    import openpyxl
+    from openpyxl.utils.exceptions import InvalidFileException
+
+    try:
+        return openpyxl.load_workbook(source, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise ValueError(f'Not a valid Excel workbook: {e}') from e
+
+
+def iter_xlsx_rows(file_data, sheet=None):
+    with _open(file_data) as source:
+        workbook = _load_workbook(source)
+        try:
+            worksheet = workbook[resolve_sheets(workbook.sheetnames, workbook.active.title, sheet)[0]]
+            for row in worksheet.iter_rows(values_only=True):
+                yield row
+        finally:
+            workbook.close()
+
+
+def iter_xlsx_sheets(file_data, sheets=None):
+    # Yield (sheet name, row generator) one sheet at a time; a sheet's rows
+    # are only parsed when its generator is consumed
+    with _open(file_data) as source:
+        workbook = _load_workbook(source)
+        try:
+            for name in resolve_sheets(workbook.sheetnames, workbook.active.title, sheets):
+                yield name, CappedRows(workbook[name].iter_rows(values_only=True))
+        finally:
+            workbook.close()
+
+
+def resolve_sheets(names, active, sheets):
+    # sheets may be None (active sheet), "all", a sheet name or a list of names
+    if not sheets:
+        return [active]
+    if sheets == 'all':
+        return list(names)
+    if isinstance(sheets, str):
+        sheets = [sheets]
+    missing = [name for name in sheets if name not in names]
+    if missing:
+        raise ValueError(f"Unknown sheet(s): {', '.join(missing)}")
+    return list(sheets)
+
+
+def single_sheet(sheets):
+    # Paths that need one header (map-reduce, row retrieval) read one named sheet or the active one
+    if isinstance(sheets, (list, tuple)) and len(sheets) == 1:
+        sheets = sheets[0]
+    if sheets == 'all' or isinstance(sheets, (list, tuple)):
+        raise ValueError('This table strategy reads one sheet; give a single sheet name')
+    return sheets or None
+
+
+_MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_PKG_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+
+def _open_archive(source):
+    try:
+        return zipfile.ZipFile(source)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f'Not a valid Excel workbook: {e}') from e
+
+
+def sheet_inventory(file_data):
+    # Sheet names and dimensions read from the workbook XML; no cell data is parsed
+    with _open(file_data) as source, _open_archive(source) as archive:
+        try:
+            workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+            rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+        except KeyError as e:
+            raise ValueError(f'Not a valid Excel workbook: {e}') from e
+        targets = {rel.get('Id'): rel.get('Target') for rel in rels.iter(_PKG_NS + 'Relationship')}
+
+        views = workbook.find(f'{_MAIN_NS}bookViews/{_MAIN_NS}workbookView')
+        active_index = int(views.get('activeTab', 0)) if views is not None else 0
+
+        inventory = []
+        for index, sheet in enumerate(workbook.iter(_MAIN_NS + 'sheet')):
+            target = targets.get(sheet.get(_REL_NS + 'id'), '')
+            path = target.lstrip('/') if target.startswith('/') else posixpath.normpath(posixpath.join('xl', target))
+            inventory.append({
+                'name': sheet.get('name'),
+                'state': sheet.get('state', 'visible'),
+                'active': index == active_index,
+                'dimension': _sheet_dimension(archive, path),
+            })
+    return inventory
+
+
+def _sheet_dimension(archive, path):
+    # Stop at the <dimension> element, which comes before the sheet data
+    try:
+        with archive.open(path) as stream:
+            for _, element in ElementTree.iterparse(stream, events=('start',)):
+                if element.tag == _MAIN_NS + 'dimension':
+                    ref = element.get('ref')
+                    return {'ref': ref, 'rows': _ref_rows(ref), 'columns': _ref_columns(ref)}
+                if element.tag == _MAIN_NS + 'sheetData':
+                    break
+    except KeyError:
+        pass
+    return None
+
+
+def _ref_rows(ref):
+    numbers = [int(n) for n in re.findall(r'\d+', ref or '')]
+    return numbers[-1] - numbers[0] + 1 if len(numbers) == 2 else (1 if numbers else 0)
+
+
+def _ref_columns(ref):
+    letters = re.findall(r'[A-Z]+', ref or '')
+
+    def column_index(text):
+        index = 0
+        for char in text:
+            index = index * 26 + ord(char) - ord('A') + 1
+        return index
+
+    return column_index(letters[-1]) - column_index(letters[0]) + 1 if letters else 0
+
+
+def iter_csv_rows(file_data):
+    # Decode incrementally instead of building one big string
+    with _open(file_data) as source:
+        text_stream = io.TextIOWrapper(source, encoding='utf-8', newline='')
+        try:
+            for row in csv.reader(text_stream):
+                yield row
+        finally:
+            text_stream.detach()
+
+
+def iter_rows(file_data, filetype, sheet=None):
+    return CappedRows(_parse_rows(file_data, filetype, sheet))
+
+
+def _parse_rows(file_data, filetype, sheet=None):
+    if is_excel(filetype):
+        return iter_xlsx_rows(file_data, sheet)
+    if is_csv(filetype):
+        return iter_csv_rows(file_data)
+    raise ValueError(f'Unsupported file type: {filetype}')
+
+
+class CappedRows:
+    # Row iterator that stops at the row cap or once the rows, as "a, b, c" lines,
+    # pass the byte cap; capped tells whether rows were left unread
+
+    def __init__(self, rows, max_rows=None, max_bytes=None):
+        self.rows = iter(rows)
+        self.max_rows = MAX_ROWS if max_rows is None else max_rows
+        self.max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+        self.count = 0
+        self.total_bytes = 0
+        self.capped = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.capped:
+            raise StopIteration
+        row = next(self.rows)
+        self.count += 1
+        if self.max_bytes:
+            self.total_bytes += len(", ".join(map(str, row)).encode('utf-8')) + 1
+        if (self.max_rows and self.count > self.max_rows) or (self.max_bytes and self.total_bytes > self.max_bytes):
+            logging.debug(f"Ingest cap reached after {self.count - 1} rows")
+            self.capped = True
+            self.close()
+            raise StopIteration
+        return row
+
+    def close(self):
+        # Let the parser close the workbook or stream right away
+        if hasattr(self.rows, 'close'):
+            self.rows.close()
+
+
+def iter_serialized_rows(rows, max_rows=None, max_bytes=None):
+    # Yield one "a, b, c" line per row, stopping at the row or byte cap
+    for row in CappedRows(rows, max_rows, max_bytes):
+        yield ", ".join(map(str, row))
+
+
+def read_table_text(file_data, filetype, max_rows=None, max_bytes=None):
+    rows = _parse_rows(file_data, filetype)
+    return "\n".join(iter_serialized_rows(rows, max_rows=max_rows, max_bytes=max_bytes))
+
+
+def legacy_table_text(file_data, filetype):
+    # The original full-load path, kept for memory comparisons
+    if is_excel(filetype):
+        import openpyxl
+        workbook = openpyxl.load_workbook(BytesIO(file_data))
+        sheet = workbook.active
+        info = [list(row) for row in sheet.iter_rows(values_only=True)]
+    else:
+        csv_data = file_data.decode('utf-8')
+        info = [row for row in csv.reader(io.StringIO(csv_data))]
+    return "\n".join([", ".join(map(str, row)) for row in info])
+
+
+def measure_peak_memory(func, *args, **kwargs):
+    # Run func and return (result, peak traced bytes, elapsed seconds)
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if not already_tracing:
+            tracemalloc.stop()
+    return result, peak, time.perf_counter() - start_time
+
+
+def compare_ingestion(file_data, filetype):
+    legacy_text, legacy_peak, legacy_time = measure_peak_memory(legacy_table_text, file_data, filetype)
+    stream_text, stream_peak, stream_time = measure_peak_memory(read_table_text, file_data, filetype, 0, 0)
+    return {
+        'file_bytes': len(file_data),
+        'legacy': {'peak_bytes': legacy_peak, 'seconds': legacy_time, 'text_bytes': len(legacy_text)},
+        'streaming': {'peak_bytes': stream_peak, 'seconds': stream_time, 'text_bytes': len(stream_text)},
+    }
+
+
+if __name__ == '__main__':
+    # Usage: python ingest.py <file.xlsx|file.csv>
+    path = sys.argv[1]
+    with open(path, 'rb') as f:
+        data = f.read()
+    report = compare_ingestion(data, path.rsplit('.', 1)[-1])
+    for mode in ('legacy', 'streaming'):
+        stats = report[mode]
+        print(f"{mode:<10} peak={stats['peak_bytes'] / 1e6:.1f} MB "
+              f"time={stats['seconds']:.2f}s text={stats['text_bytes'] / 1e6:.1f} MB")
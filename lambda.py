@@ -1,18 +1,57 @@
 import json
-import boto3
-import openpyxl
-import csv
-import io
-import mammoth  # For docx/doc to text conversion
-from io import BytesIO
+import os
+import uuid
+from clients import get_client
+from response_cache import cached_invoke
+from prompt_cache import cached_text_block, cache_usage, stats as prompt_cache_stats
+from throttling import default_concurrency
+from table_text import table_text_for, input_budget
+from s3_cache import cached_table_text, cached_row_index, fetch_object, parse_s3_reference
+from ingest import is_excel, iter_rows, preload, sheet_inventory, single_sheet
+from row_index import index_for
+from tracing import traced, span, set_property
 import base64
 
+# Static config and clients are set up once per container, in the Lambda init phase,
+# so the first request does not pay for them. Parser libraries (openpyxl) load on the
+# first request for their format unless listed in PRELOAD_FORMATS, e.g. "xlsx" for
+# provisioned concurrency where init runs ahead of traffic.
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+DEFAULT_BUCKET = 'bedrocktest03'
+DEFAULT_KEY = 'Employee_Details-2.xlsx'
+PRELOAD_FORMATS = [f for f in os.environ.get('PRELOAD_FORMATS', '').split(',') if f.strip()]
 
+# Where action "upload_url" lets clients upload files, and how long the presigned URL is valid
+UPLOAD_BUCKET = os.environ.get('UPLOAD_BUCKET', DEFAULT_BUCKET)
+UPLOAD_PREFIX = os.environ.get('UPLOAD_PREFIX', 'uploads/')
+UPLOAD_URL_SECONDS = int(os.environ.get('UPLOAD_URL_SECONDS', '900'))
+
+# "s3" references may only name the default file or uploads under UPLOAD_PREFIX in these
+# buckets, so a caller cannot read other objects the Lambda role has access to
+ALLOWED_BUCKETS = {UPLOAD_BUCKET, DEFAULT_BUCKET}
+
+bedrock_client = get_client('bedrock-runtime', region_name='us-east-1')
+get_client('s3')  # Used by s3_cache for the default file
+preload(PRELOAD_FORMATS)
+
+
+def allowed_reference(bucket, key):
+    if (bucket, key) == (DEFAULT_BUCKET, DEFAULT_KEY):
+        return True
+    return bucket in ALLOWED_BUCKETS and key.startswith(UPLOAD_PREFIX)
+
+
+@traced('lambda_handler')
 def lambda_handler(event, context):
     print(event)
     user_prompt = event.get('prompt', '')
     base64_file = event.get('file', '')
+    s3_file = event.get('s3')  # Instead of "file": {"bucket", "key"}, "s3://bucket/key" or the URL it was uploaded to
     filetype = event.get('filetype', '')  # Default empty string if not provided
+    max_input_tokens = event.get('max_input_tokens')  # Token budget for the file contents
+    table_strategy = event.get('table_strategy')  # truncate, head_tail, summary, map_reduce or retrieve
+    table_format = event.get('table_format')  # plain or compact
+    sheets = event.get('sheets')  # Workbook sheets: a name, a list of names or "all" (default: active sheet)
 
     # Check if filetype is provided and handle unsupported types
     # if not filetype:
@@ -38,61 +77,120 @@ def lambda_handler(event, context):
         ]
     }
 
+    # Keep the file contents within the input-token budget
+    budget = input_budget(request_body["max_tokens"], user_prompt, max_input_tokens)
+
     try:
+        if event.get('action') == 'upload_url':
+            # Presigned PUT so large files go straight to S3 (no 6 MB event limit, no base64);
+            # the question is then sent with the returned "s3" reference
+            file_key = f"{UPLOAD_PREFIX}{uuid.uuid4().hex}.{filetype or 'xlsx'}"
+            upload_url = get_client('s3').generate_presigned_url(
+                'put_object', Params={'Bucket': UPLOAD_BUCKET, 'Key': file_key}, ExpiresIn=UPLOAD_URL_SECONDS)
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'upload_url': upload_url, 's3': {'bucket': UPLOAD_BUCKET, 'key': file_key},
+                                    'expires_in': UPLOAD_URL_SECONDS})
+            }
+
         if base64_file:
             # Decode the base64 content
-            file_data = base64.b64decode(base64_file)
+            with span('decode'):
+                file_data = base64.b64decode(base64_file)
         else:
-            # Create an S3 client
-            s3_client = boto3.client('s3')
-            filetype = 'xlsx'
-
-            # S3 bucket and file key details
-            bucket_name = 'bedrocktest03'
-            file_key = 'Employee_Details-2.' + filetype  # Adjust file extension based on 'filetype'
-
-            # Retrieve the file from S3
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_data = s3_object['Body'].read()
-
-        if filetype.lower() == 'xlsx' or filetype.lower() == 'xls':
-            # Read the Excel file
-            excel_file = BytesIO(file_data)
-            workbook = openpyxl.load_workbook(excel_file)
-            sheet = workbook.active
-
-            # Extract information from the Excel file
-            excel_info = []
-            for row in sheet.iter_rows(values_only=True):
-                excel_info.append(list(row))
-
-            # Convert Excel data to a readable string format
-            excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-
-            # Add Excel data as text to the request body
-            request_body["messages"][0]["content"].append({
+            if s3_file:
+                reference = parse_s3_reference(s3_file)
+                if reference is None:
+                    return {
+                        'statusCode': 400,
+                        'body': json.dumps({'error': f'Unrecognized S3 reference: {s3_file}'})
+                    }
+                bucket_name, file_key = reference
+                if not allowed_reference(bucket_name, file_key):
+                    return {
+                        'statusCode': 403,
+                        'body': json.dumps({'error': f'S3 reference not allowed: s3://{bucket_name}/{file_key}'})
+                    }
+                filetype = filetype or file_key.rsplit('.', 1)[-1]
+            else:
+                filetype = 'xlsx'
+
+                # S3 bucket and file key details
+                bucket_name = DEFAULT_BUCKET
+                file_key = DEFAULT_KEY
+
+            # S3 objects are streamed to the /tmp cache and parsed from there, never held whole in memory
+            file_data = None
+
+        set_property('filetype', filetype)
+        set_property('table_strategy', table_strategy or 'default')
+
+        if event.get('action') == 'sheet_inventory':
+            # Sheet names and dimensions only; no cell data is parsed
+            if not is_excel(filetype):
+                return {
+                    'statusCode': 400,
+                    'body': json.dumps({'error': f'sheet_inventory needs an Excel workbook, not {filetype}'})
+                }
+            if file_data is None:
+                file_data = fetch_object(bucket_name, file_key)[1]
+            return {
+                'statusCode': 200,
+                'body': json.dumps({'sheets': sheet_inventory(file_data)})
+            }
+
+        if table_strategy == 'map_reduce' and filetype.lower() in ('xlsx', 'xls', 'csv'):
+            # Answer over the whole file in chunks that each fit the budget, then combine
+            from mapreduce import map_reduce  # Only this strategy needs it
+            if file_data is None:
+                file_data = fetch_object(bucket_name, file_key)[1]
+            result = map_reduce(bedrock_client, MODEL_ID, user_prompt, iter_rows(file_data, filetype, single_sheet(sheets)),
+                                budget, request_body["max_tokens"])
+            print("Map-reduce stats:", result['map_reduce'])
+            print("Throttling stats:", default_concurrency.snapshot())
+            return {
+                'statusCode': 200,
+                'body': json.dumps(result)
+            }
+
+        if table_strategy == 'retrieve' and filetype.lower() in ('xlsx', 'xls', 'csv'):
+            # Send only the header and the rows that match the prompt; the index is built once per file
+            if file_data is None:
+                index = cached_row_index(bucket_name, file_key, filetype, single_sheet(sheets), table_format=table_format)
+            else:
+                index = index_for(file_data, filetype, single_sheet(sheets), table_format)
+            data_text, table_stats = index.table_text(user_prompt, budget, event.get('top_k'))
+            label = 'CSV' if filetype.lower() == 'csv' else 'Excel'
+
+            # Add the retrieved rows ahead of the prompt (not cached: they depend on the prompt)
+            request_body["messages"][0]["content"].insert(0, {
                 "type": "text",
-                "text": f"Excel file contents:\n{excel_data_text}"
+                "text": f"{label} file contents:\n{data_text}"
             })
 
-        elif filetype.lower() == 'csv':
-            # Read the CSV file
-            csv_data = file_data.decode('utf-8')  # Decode bytes to string
-            csv_reader = csv.reader(io.StringIO(csv_data))
+        elif filetype.lower() == 'xlsx' or filetype.lower() == 'xls':
+            if file_data is None:
+                # Revalidate the cached copy with S3; unchanged objects skip both download and parse
+                excel_data_text, table_stats = cached_table_text(bucket_name, file_key, filetype, budget, table_strategy,
+                                                                  table_format=table_format, sheets=sheets)
+            else:
+                # Stream the Excel rows into a readable string format within the token budget
+                excel_data_text, table_stats = table_text_for(file_data, filetype, budget, table_strategy, table_format,
+                                                              sheets)
 
-            # Process CSV rows
-            csv_info = []
-            for row in csv_reader:
-                csv_info.append(row)
+            # Add Excel data ahead of the prompt as a cacheable prefix
+            request_body["messages"][0]["content"].insert(0, cached_text_block(f"Excel file contents:\n{excel_data_text}"))
 
-            # Convert CSV data to a readable string format
-            csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
+        elif filetype.lower() == 'csv':
+            if file_data is None:
+                csv_data_text, table_stats = cached_table_text(bucket_name, file_key, filetype, budget, table_strategy,
+                                                                table_format=table_format)
+            else:
+                # Stream the CSV rows into a readable string format within the token budget
+                csv_data_text, table_stats = table_text_for(file_data, filetype, budget, table_strategy, table_format)
 
-            # Add CSV data as text to the request body
-            request_body["messages"][0]["content"].append({
-                "type": "text",
-                "text": f"CSV file contents:\n{csv_data_text}"
-            })
+            # Add CSV data ahead of the prompt as a cacheable prefix
+            request_body["messages"][0]["content"].insert(0, cached_text_block(f"CSV file contents:\n{csv_data_text}"))
 
 
         else:
@@ -102,30 +200,26 @@ def lambda_handler(event, context):
                 'body': json.dumps({'error': f'Unsupported file type: {filetype}'})
             }
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
-
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
-
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        print("Full Response Payload:", response_payload)
-
-        # Parse the payload
-        payload = json.loads(response_payload)
+        # Send the request to Bedrock (identical requests are served from the response cache)
+        payload = cached_invoke(bedrock_client, MODEL_ID, request_body)
+        print("Full Response Payload:", json.dumps(payload))
+        print("Throttling stats:", default_concurrency.snapshot())
+        print("Prompt cache stats:", prompt_cache_stats)
         generated_text = payload.get('completions', [{}])[0].get('text', '')
 
         # Return the generated text
         return {
             'statusCode': 200,
-            'body': json.dumps({'generated_text': generated_text, 'response': payload})
+            'body': json.dumps({'generated_text': generated_text, 'response': payload, 'table_stats': table_stats,
+                                'prompt_cache': cache_usage(payload)})
+        }
+
+    except ValueError as e:
+        # Invalid input: unknown sheet, table strategy or format, or a file that cannot be decoded
+        # (including an "xlsx" that is not a workbook)
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': str(e)})
         }
 
     except Exception as e:
@@ -1,5 +1,6 @@
 import streamlit as st
-import boto3
+from clients import get_client
+from dataframes import load_dataframe, render_preview
 import pandas as pd
 from langchain_community.chat_models import BedrockChat
 from langchain_experimental.agents import create_pandas_dataframe_agent
@@ -14,7 +15,7 @@ uploaded_file = st.file_uploader("Upload your CSV or Excel file", type=["csv", "
 query = st.text_input("Enter your query")
 
 # Set up the BedrockChat model
-client = boto3.client('bedrock-runtime', region_name='us-east-1')
+client = get_client('bedrock-runtime', region_name='us-east-1')
 
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 model_kwargs = {
@@ -32,14 +33,15 @@ model = BedrockChat(
 )
 
 if uploaded_file is not None:
-    # Read the file into a DataFrame
-    if uploaded_file.name.endswith('.csv'):
-        df = pd.read_csv(uploaded_file)
-    elif uploaded_file.name.endswith('.xlsx'):
-        df = pd.read_excel(uploaded_file)
-    
+    # Read the file into a DataFrame once per upload (Arrow-backed when pyarrow is installed)
+    loaded = st.session_state.setdefault('loaded', {})
+    if uploaded_file.file_id not in loaded:
+        loaded.clear()
+        loaded[uploaded_file.file_id] = load_dataframe(uploaded_file.getvalue(), uploaded_file.name.split('.')[-1])
+    df, load_stats = loaded[uploaded_file.file_id]
+
     st.write("DataFrame Preview:")
-    st.write(df.head())
+    render_preview(df, load_stats, key='agent')
 
     # Create the agent
     agent = create_pandas_dataframe_agent(model, df, verbose=True, allow_dangerous_code=True)
@@ -0,0 +1,249 @@
+# Local stand-ins for the bedrock-runtime and S3 clients.
+# Selected with AWS_BACKEND=local (see clients.get_client), so the handlers
+# and process_event run without AWS and our own overhead can be measured.
+# Model calls get injected latency, throttling and token-paced streaming;
+# S3 objects are files under LOCAL_S3_DIR/<bucket>/<key>.
+
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from prompt_cache import PromptCacheStub
+
+# Latency before the first token: "fixed:S", "uniform:LOW,HIGH" or "lognormal:MEDIAN,SIGMA" (seconds)
+LATENCY = os.environ.get('LOCAL_LATENCY', 'lognormal:0.6,0.4')
+
+# Fraction of model calls rejected with ThrottlingException, and the number of
+# concurrent calls above which every call is throttled (0 = no limit)
+THROTTLE_RATE = float(os.environ.get('LOCAL_THROTTLE_RATE', '0'))
+MAX_CONCURRENCY = int(os.environ.get('LOCAL_MAX_CONCURRENCY', '0'))
+
+# Output pacing and size
+TOKENS_PER_SECOND = float(os.environ.get('LOCAL_TOKENS_PER_SECOND', '60'))
+OUTPUT_TOKENS = int(os.environ.get('LOCAL_OUTPUT_TOKENS', '60'))
+
+S3_DIR = os.environ.get('LOCAL_S3_DIR', '/tmp/local-s3')
+S3_LATENCY = os.environ.get('LOCAL_S3_LATENCY', 'fixed:0.02')
+
+WORDS = ('the', 'table', 'shows', 'employee', 'records', 'with', 'salary', 'department', 'and', 'location',
+         'values', 'for', 'each', 'row', 'in', 'total')
+
+
+def latency_sampler(spec):
+    # Return a function that draws one latency in seconds from spec
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda: median * random.lognormvariate(0, sigma)
+    raise ValueError(f'Unknown latency distribution: {spec}')
+
+
+def _client_error(code, message, status, operation):
+    return ClientError({'Error': {'Code': code, 'Message': message},
+                        'ResponseMetadata': {'HTTPStatusCode': status}}, operation)
+
+
+class LocalBedrockRuntime(PromptCacheStub):
+    # invoke_model, invoke_model_with_response_stream and converse with
+    # prompt-cache usage from PromptCacheStub
+
+    def __init__(self, latency=LATENCY, throttle_rate=THROTTLE_RATE, max_concurrency=MAX_CONCURRENCY,
+                 tokens_per_second=TOKENS_PER_SECOND, output_tokens=OUTPUT_TOKENS, reply=None):
+        super().__init__(reply=reply)
+        self.latency = latency_sampler(latency)
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.stats = {'calls': 0, 'throttled': 0, 'max_in_flight': 0}
+        self._in_flight = 0
+        self._stats_lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, **kwargs):
+        with self._call('InvokeModel'):
+            response = super().invoke_model(modelId, body)
+            payload = json.loads(response['body'].read())
+            time.sleep(self.latency() + payload['usage']['output_tokens'] / self.tokens_per_second)
+            return {'body': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+
+    def converse(self, modelId, messages, system=None, inferenceConfig=None, **kwargs):
+        with self._call('Converse'):
+            response = super().converse(modelId, messages, system, inferenceConfig)
+            time.sleep(self.latency() + response['usage']['outputTokens'] / self.tokens_per_second)
+            return response
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._begin('InvokeModelWithResponseStream')
+        try:
+            payload = json.loads(super().invoke_model(modelId, body)['body'].read())
+        except Exception:
+            self._end()
+            raise
+        return {'body': self._events(payload)}
+
+    def _events(self, payload):
+        def event(data):
+            return {'chunk': {'bytes': json.dumps(data).encode('utf-8')}}
+
+        usage = payload['usage']
+        try:
+            time.sleep(self.latency())
+            yield event({'type': 'message_start', 'message': {'role': 'assistant', 'usage': {
+                'input_tokens': usage['input_tokens'],
+                'cache_read_input_tokens': usage['cache_read_input_tokens'],
+                'cache_creation_input_tokens': usage['cache_creation_input_tokens'],
+            }}})
+            yield event({'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+            for i, word in enumerate(payload['content'][0]['text'].split(' ')):
+                time.sleep(1 / self.tokens_per_second)
+                yield event({'type': 'content_block_delta', 'index': 0,
+                             'delta': {'type': 'text_delta', 'text': word if i == 0 else ' ' + word}})
+            yield event({'type': 'content_block_stop', 'index': 0})
+            yield event({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'},
+                         'usage': {'output_tokens': usage['output_tokens']}})
+            yield event({'type': 'message_stop'})
+        finally:
+            self._end()
+
+    def response_text(self, max_tokens):
+        # Roughly one token per word, capped by the request's max_tokens
+        if self.reply:
+            return self.reply
+        count = max(1, min(self.output_tokens, max_tokens or self.output_tokens))
+        return ' '.join(WORDS[i % len(WORDS)] for i in range(count)).capitalize() + '.'
+
+    def _begin(self, operation):
+        # Count the call and throttle it at random or when too many are in flight
+        with self._stats_lock:
+            self.stats['calls'] += 1
+            throttled = random.random() < self.throttle_rate or (
+                self.max_concurrency and self._in_flight >= self.max_concurrency)
+            if throttled:
+                self.stats['throttled'] += 1
+                raise _client_error('ThrottlingException', 'Too many requests, please wait before trying again.',
+                                    429, operation)
+            self._in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self._in_flight)
+
+    def _end(self):
+        with self._stats_lock:
+            self._in_flight -= 1
+
+    @contextlib.contextmanager
+    def _call(self, operation):
+        self._begin(operation)
+        try:
+            yield
+        finally:
+            self._end()
+
+
+class LocalS3:
+    # get_object (with IfNoneMatch), put_object, upload_fileobj, generate_presigned_url and
+    # list_objects_v2 over a directory
+
+    def __init__(self, root=S3_DIR, latency=S3_LATENCY):
+        self.root = root
+        self.latency = latency_sampler(latency)
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    @staticmethod
+    def _etag(data):
+        return '"' + hashlib.md5(data).hexdigest() + '"'
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        time.sleep(self.latency())
+        try:
+            with open(self._path(Bucket, Key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            raise _client_error('NoSuchKey', 'The specified key does not exist.', 404, 'GetObject')
+        etag = self._etag(data)
+        if IfNoneMatch == etag:
+            raise _client_error('304', 'Not Modified', 304, 'GetObject')
+        modified = datetime.datetime.fromtimestamp(os.path.getmtime(self._path(Bucket, Key)), datetime.timezone.utc)
+        return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data), 'LastModified': modified}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        time.sleep(self.latency())
+        data = Body if isinstance(Body, bytes) else Body.read()
+        path = self._path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return {'ETag': self._etag(data)}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj)
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        # A file URL for the object; there is nothing to sign locally
+        return 'file://' + self._path(Params['Bucket'], Params['Key'])
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        time.sleep(self.latency())
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, names in os.walk(bucket_dir):
+            for name in names:
+                key = os.path.relpath(os.path.join(directory, name), bucket_dir).replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        keys.sort()
+
+        # The continuation token is the last key of the previous page
+        if ContinuationToken:
+            keys = [key for key in keys if key > ContinuationToken]
+        page, truncated = keys[:MaxKeys], len(keys) > MaxKeys
+        contents = []
+        for key in page:
+            path = self._path(Bucket, key)
+            with open(path, 'rb') as f:
+                etag = self._etag(f.read())
+            contents.append({
+                'Key': key,
+                'Size': os.path.getsize(path),
+                'ETag': etag,
+                'LastModified': datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc),
+            })
+        response = {'Name': Bucket, 'Prefix': Prefix, 'KeyCount': len(contents), 'Contents': contents,
+                    'IsTruncated': truncated}
+        if truncated:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+
+def local_client(service):
+    if service == 'bedrock-runtime':
+        return LocalBedrockRuntime()
+    if service == 's3':
+        return LocalS3()
+    raise ValueError(f'No local stand-in for {service}')
+
+
+if __name__ == '__main__':
+    # Usage: python local_aws.py <file> [bucket] [key]
+    # Copies a file into the local S3 directory (default: the handlers' sample workbook)
+    import sys
+
+    path = sys.argv[1]
+    bucket = sys.argv[2] if len(sys.argv) > 2 else 'bedrocktest03'
+    key = sys.argv[3] if len(sys.argv) > 3 else 'Employee_Details-2.xlsx'
+    with open(path, 'rb') as f:
+        LocalS3().put_object(Bucket=bucket, Key=key, Body=f.read())
+    print(f"Stored {path} as s3://{bucket}/{key} under {S3_DIR}")
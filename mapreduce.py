@@ -0,0 +1,115 @@
+# Map-reduce question answering for tables larger than one context window.
+# The table is split into row chunks that each fit the token budget (the
+# header is repeated in every chunk), the chunks are sent to Bedrock in
+# parallel, and a final reduce call combines the partial answers.
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from response_cache import cached_invoke, message_body, response_text
+from table_text import estimate_tokens, serialize_row
+from tracing import bind
+
+MAX_WORKERS = int(os.environ.get('MAP_REDUCE_WORKERS', '8'))
+
+# Chunks are at least this many times max_tokens, so a reduce request holds
+# several partial answers (each up to max_tokens) and every round shrinks them
+MIN_CHUNK_FACTOR = int(os.environ.get('MAP_REDUCE_MIN_CHUNK_FACTOR', '4'))
+
+# Partial answers that carry no information are dropped before the reduce step
+NO_DATA = 'NO RELEVANT DATA'
+
+MAP_INSTRUCTIONS = (
+    "You are given one chunk of a larger table. Answer the question using only the rows in this chunk. "
+    "Include the counts, sums or values you used so the partial answers can be combined later. "
+    f"If the chunk has nothing relevant to the question, reply exactly \"{NO_DATA}\"."
+)
+
+REDUCE_INSTRUCTIONS = (
+    "The table was too large to read at once, so the question was answered separately for each chunk of rows. "
+    "Combine the partial answers below into one final answer to the question. "
+    "Add up counts and totals across chunks where needed and do not mention the chunks."
+)
+
+
+def chunk_rows(rows, chunk_tokens, serialize=serialize_row):
+    # Yield chunk texts of at most chunk_tokens, each starting with the header row
+    header = None
+    lines, tokens = [], 0
+    for row in rows:
+        line = serialize(row)
+        if header is None:
+            header = line
+            header_tokens = estimate_tokens(header) + 1
+            continue
+        line_tokens = estimate_tokens(line) + 1
+        if lines and header_tokens + tokens + line_tokens > chunk_tokens:
+            yield "\n".join([header] + lines)
+            lines, tokens = [], 0
+        lines.append(line)
+        tokens += line_tokens
+    if lines or header is not None:
+        yield "\n".join([header] + lines)
+
+
+def _reduce(client, model_id, question, partials, budget, max_tokens):
+    # Combine partial answers, reducing in groups when they do not fit one request.
+    # A group always takes at least two partials, so each round has fewer than the last
+    groups, group, group_tokens = [], [], 0
+    for partial in partials:
+        partial_tokens = estimate_tokens(partial) + 4
+        if len(group) >= 2 and group_tokens + partial_tokens > budget:
+            groups.append(group)
+            group, group_tokens = [], 0
+        group.append(partial)
+        group_tokens += partial_tokens
+    if len(group) == 1 and groups:
+        groups[-1].extend(group)
+    else:
+        groups.append(group)
+
+    def combine(group):
+        answers = "\n\n".join(f"Partial answer {i + 1}:\n{partial}" for i, partial in enumerate(group))
+        text = f"{REDUCE_INSTRUCTIONS}\n\nQuestion: {question}\n\n{answers}"
+        return cached_invoke(client, model_id, message_body(text, max_tokens))
+
+    if len(groups) == 1:
+        return combine(groups[0])
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        payloads = list(executor.map(bind(combine), groups))
+    return _reduce(client, model_id, question, [response_text(p) for p in payloads], budget, max_tokens)
+
+
+def map_reduce(client, model_id, question, rows, chunk_tokens, max_tokens=900, max_workers=None):
+    start_time = time.perf_counter()
+    min_chunk_tokens = max_tokens * MIN_CHUNK_FACTOR
+    if chunk_tokens < min_chunk_tokens:
+        logging.debug(f"Map-reduce: raising chunk budget from {chunk_tokens} to {min_chunk_tokens} tokens")
+        chunk_tokens = min_chunk_tokens
+
+    def answer_chunk(chunk):
+        text = f"{MAP_INSTRUCTIONS}\n\nQuestion: {question}\n\nTable chunk:\n{chunk}"
+        return response_text(cached_invoke(client, model_id, message_body(text, max_tokens)))
+
+    # The map calls run in a bounded pool (cached_invoke adds retries and adaptive concurrency)
+    with ThreadPoolExecutor(max_workers=max_workers or MAX_WORKERS) as executor:
+        partials = list(executor.map(bind(answer_chunk), chunk_rows(rows, chunk_tokens)))
+    map_time = time.perf_counter() - start_time
+
+    relevant = [partial for partial in partials if partial.strip() != NO_DATA]
+    logging.debug(f"Map-reduce: {len(partials)} chunks, {len(relevant)} with relevant data")
+    payload = _reduce(client, model_id, question, relevant or [NO_DATA], chunk_tokens, max_tokens)
+
+    return {
+        'generated_text': response_text(payload),
+        'response': payload,
+        'map_reduce': {
+            'chunks': len(partials),
+            'chunk_tokens': chunk_tokens,
+            'relevant_chunks': len(relevant),
+            'map_seconds': map_time,
+            'total_seconds': time.perf_counter() - start_time,
+        },
+    }
@@ -1,125 +1,276 @@
-import boto3
-import openpyxl
-import csv
-import io
-from io import BytesIO
+from clients import get_client
+from response_cache import cached_invoke
+from prompt_cache import cached_text_block, cache_usage
+from table_text import table_text_for, input_budget, estimate_tokens
+from s3_cache import cached_table_text, cached_row_index, fetch_object, parse_s3_reference
+from ingest import iter_rows, is_excel, single_sheet
+from row_index import index_for
+from mapreduce import map_reduce
+from streaming import ResponseStream
+from rate_limit import RateLimiter
+from tracing import traced, bind
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import base64
 import json
 import logging
+import time
 
 logging.basicConfig(level=logging.DEBUG)
 
-def process_event(prompt, file_contents, filetype):
-    try:
-        logging.debug(f"Prompt: {prompt}")
-        logging.debug(f"Filetype: {filetype}")
+MAX_TOKENS = 900
+
+# Model ID for Claude 3 Sonnet
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+# File used when no file is uploaded
+BUCKET_NAME = 'bedrocktest03'
+DEFAULT_FILE_KEY = 'Employee_Details-2.xlsx'
 
-        if file_contents:
-            logging.debug("Processing file contents...")
-            if filetype.lower() in ['xlsx', 'xls',"vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                # Read Excel file
-                excel_file = BytesIO(file_contents)
-                workbook = openpyxl.load_workbook(excel_file)
-                sheet = workbook.active
-
-                # Process Excel data
-                excel_info = []
-                for row in sheet.iter_rows(values_only=True):
-                    excel_info.append(list(row))
-
-                # Convert Excel data to a readable string format
-                excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-                logging.debug(f"Excel data text: {excel_data_text}")
-
-                # Add Excel data as text to the request body
-                prompt += f"\nExcel file contents:\n{excel_data_text}"
-
-            elif filetype.lower() == 'csv':
-                # Read CSV file
-                csv_data = file_contents.decode('utf-8')
-                csv_reader = csv.reader(io.StringIO(csv_data))
-
-                # Process CSV rows
-                csv_info = []
-                for row in csv_reader:
-                    csv_info.append(row)
-
-                # Convert CSV data to a readable string format
-                csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
-                logging.debug(f"CSV data text: {csv_data_text}")
-
-                # Add CSV data as text to the request body
-                prompt += f"\nCSV file contents:\n{csv_data_text}"
-            
-            else:
-                logging.debug(f"Unhandled file type: {filetype}")
+
+def s3_file(file_contents, filetype):
+    # (bucket, key, filetype) when file_contents is an S3 reference ("s3://bucket/key") or
+    # empty (the default file); None for uploaded file bytes
+    if not file_contents:
+        return BUCKET_NAME, DEFAULT_FILE_KEY, 'xlsx'
+    reference = parse_s3_reference(file_contents)
+    if reference is None:
+        return None
+    bucket, key = reference
+    return bucket, key, filetype or key.rsplit('.', 1)[-1]
+
+
+def file_section(file_contents, filetype, budget, table_strategy=None, table_format=None, sheets=None):
+    # Serialized file contents to append to the prompt, and the table stats
+    source = s3_file(file_contents, filetype)
+    if source is None:
+        logging.debug("Processing file contents...")
+        if filetype.lower() in ['xlsx', 'xls',"vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
+            # Stream the Excel rows into a readable string format within the token budget
+            excel_data_text, table_stats = table_text_for(file_contents, filetype, budget, table_strategy,
+                                                          table_format, sheets)
+            logging.debug(f"Excel data text: {excel_data_text}")
+            return f"\nExcel file contents:\n{excel_data_text}", table_stats
+
+        elif filetype.lower() == 'csv':
+            # Stream the CSV rows into a readable string format within the token budget
+            csv_data_text, table_stats = table_text_for(file_contents, filetype, budget, table_strategy, table_format)
+            logging.debug(f"CSV data text: {csv_data_text}")
+            return f"\nCSV file contents:\n{csv_data_text}", table_stats
 
         else:
-            logging.debug("No file contents provided, using S3 file.")
-            # Simulate fetching a file from S3 if no file is uploaded
-            s3_client = boto3.client('s3')
-            bucket_name = 'bedrocktest03'
-            file_key = 'Employee_Details-2.xlsx'  # Adjust file extension based on 'filetype'
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_data = s3_object['Body'].read()
-
-            # Assume the file is an Excel file for this example
-            excel_file = BytesIO(file_data)
-            workbook = openpyxl.load_workbook(excel_file)
-            sheet = workbook.active
-            excel_info = []
-            for row in sheet.iter_rows(values_only=True):
-                excel_info.append(list(row))
-            excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-            logging.debug(f"Excel data text from S3: {excel_data_text}")
-            prompt += f"\nExcel file contents:\n{excel_data_text}"
-
-        # Create a request body for Bedrock
-        request_body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 900,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
-                }
-            ]
-        }
+            logging.debug(f"Unhandled file type: {filetype}")
+            return '', None
 
-        logging.debug(f"Request Body: {json.dumps(request_body)}")
+    bucket, key, filetype = source
+    logging.debug(f"Using S3 file s3://{bucket}/{key}")
+    if not (is_excel(filetype) or filetype.lower() == 'csv'):
+        logging.debug(f"Unhandled file type: {filetype}")
+        return '', None
+    # The /tmp cache skips the download and parse while the object is unchanged
+    data_text, table_stats = cached_table_text(bucket, key, filetype, budget, table_strategy,
+                                               table_format=table_format, sheets=sheets)
+    label = 'Excel' if is_excel(filetype) else 'CSV'
+    logging.debug(f"{label} data text from S3: {data_text}")
+    return f"\n{label} file contents:\n{data_text}", table_stats
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
 
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+def retrieval_section(prompt, file_contents, filetype, budget, sheets=None, table_format=None):
+    # Only the header and the rows that match the prompt, from a per-file BM25 index
+    sheet = single_sheet(sheets)
+    source = s3_file(file_contents, filetype)
+    if source is not None:
+        bucket, key, filetype = source
+        logging.debug(f"Using S3 file s3://{bucket}/{key}")
+    if not (is_excel(filetype) or filetype.lower() == 'csv'):
+        logging.debug(f"Unhandled file type: {filetype}")
+        return '', None
+    if source is not None:
+        index = cached_row_index(bucket, key, filetype, sheet, table_format=table_format)
+    else:
+        index = index_for(file_contents, filetype, sheet, table_format)
+    label = 'Excel' if is_excel(filetype) else 'CSV'
+    data_text, table_stats = index.table_text(prompt, budget)
+    logging.debug(f"Retrieved rows: {data_text}")
+    return f"\n{label} file contents:\n{data_text}", table_stats
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
 
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        logging.debug(f"Response Payload: {response_payload}")
+def build_request_body(prompt, file_contents, filetype, max_input_tokens=None, table_strategy=None,
+                       section=None, table_format=None, sheets=None):
+    # section is a precomputed (text, table_stats) from file_section
+    if section is None:
+        budget = input_budget(MAX_TOKENS, prompt, max_input_tokens)
+        if table_strategy == 'retrieve':
+            section = retrieval_section(prompt, file_contents, filetype, budget, sheets, table_format)
+        else:
+            section = file_section(file_contents, filetype, budget, table_strategy, table_format, sheets)
+    section_text, table_stats = section
 
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
+    if table_stats:
+        logging.debug(f"Table stats: {table_stats}")
+
+    # The file contents go first and end a cacheable prefix, so repeated questions
+    # about one file reuse the prompt cache; retrieved rows depend on the question
+    content = []
+    if section_text:
+        file_text = section_text.lstrip("\n")
+        if table_strategy == 'retrieve':
+            content.append({"type": "text", "text": file_text})
+        else:
+            content.append(cached_text_block(file_text))
+    content.append({"type": "text", "text": prompt})
+
+    # Create a request body for Bedrock
+    request_body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": MAX_TOKENS,
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    }
+    return request_body, table_stats
+
+
+def invoke_request(request_body, table_stats=None):
+    logging.debug(f"Request Body: {json.dumps(request_body)}")
+
+    # Get the shared Bedrock runtime client (replace with your region)
+    client = get_client('bedrock-runtime', region_name='us-east-1')
+
+    # Send the request to Bedrock (identical requests are served from the response cache)
+    payload = cached_invoke(client, MODEL_ID, request_body)
+    logging.debug(f"Response Payload: {json.dumps(payload)}")
+
+    generated_text = payload.get('completions', [{}])[0].get('text', '')
+
+    # Return the generated text
+    return {
+        'generated_text': generated_text,
+        'response': payload,
+        'table_stats': table_stats,
+        'prompt_cache': cache_usage(payload)
+    }
 
-        # Return the generated text
-        return {
-            'generated_text': generated_text,
-            'response': payload
-        }
+
+@traced('process_event')
+def process_event(prompt, file_contents, filetype, max_input_tokens=None, table_strategy=None, table_format=None,
+                  sheets=None):
+    try:
+        logging.debug(f"Prompt: {prompt}")
+        logging.debug(f"Filetype: {filetype}")
+
+        if table_strategy == 'map_reduce':
+            return map_reduce_event(prompt, file_contents, filetype, max_input_tokens, sheets)
+
+        request_body, table_stats = build_request_body(
+            prompt, file_contents, filetype, max_input_tokens, table_strategy, table_format=table_format, sheets=sheets)
+        return invoke_request(request_body, table_stats)
 
     except Exception as e:
         logging.error(f"Error: {str(e)}")
         return {
             'error': str(e)
         }
+
+
+def map_reduce_event(prompt, file_contents, filetype, max_input_tokens=None, sheets=None):
+    # Answer over the whole file in token-budget-sized chunks, then combine
+    sheet = single_sheet(sheets)
+    source = s3_file(file_contents, filetype)
+    if source is None:
+        rows = iter_rows(file_contents, filetype, sheet)
+    else:
+        bucket, key, filetype = source
+        logging.debug(f"Using S3 file s3://{bucket}/{key}")
+        # Parsed from the /tmp copy, so the object is never held in memory whole
+        rows = iter_rows(fetch_object(bucket, key)[1], filetype, sheet)
+
+    client = get_client('bedrock-runtime', region_name='us-east-1')
+    chunk_tokens = input_budget(MAX_TOKENS, prompt, max_input_tokens)
+    result = map_reduce(client, MODEL_ID, prompt, rows, chunk_tokens, MAX_TOKENS)
+    logging.debug(f"Map-reduce stats: {result['map_reduce']}")
+    return result
+
+
+def stream_event(prompt, file_contents, filetype, max_input_tokens=None, table_strategy=None, table_format=None,
+                 sheets=None):
+    # Same request as process_event, but returns a ResponseStream that yields
+    # text deltas as they arrive (timings are in stream.metrics)
+    logging.debug(f"Prompt: {prompt}")
+    logging.debug(f"Filetype: {filetype}")
+
+    if table_strategy == 'map_reduce':
+        # The answer only exists after the final reduce call; use process_event
+        raise ValueError('map_reduce answers cannot be streamed; use process_event')
+
+    request_body, table_stats = build_request_body(
+        prompt, file_contents, filetype, max_input_tokens, table_strategy, table_format=table_format, sheets=sheets)
+
+    client = get_client('bedrock-runtime', region_name='us-east-1')
+    stream = ResponseStream(client, MODEL_ID, request_body)
+    stream.table_stats = table_stats
+    return stream
+
+
+def process_batch(jobs, max_workers=8, requests_per_second=None, tokens_per_minute=None,
+                  max_input_tokens=None, table_strategy=None, table_format=None, sheets=None):
+    # Run many (prompt, file_contents, filetype) jobs concurrently and yield
+    # results in completion order with per-job latency
+    jobs = list(jobs)
+    limiter = RateLimiter(requests_per_second, tokens_per_minute)
+
+    # Serialize each distinct file once per budget (the budget depends on the
+    # prompt length) and share it across its jobs; with retrieval each job gets
+    # its own rows, so only the index is shared. Map-reduce jobs read the file themselves
+    sections = {}
+    for prompt, file_contents, filetype in jobs:
+        budget = input_budget(MAX_TOKENS, prompt, max_input_tokens)
+        key = (file_contents, filetype, budget)
+        if table_strategy != 'map_reduce' and key not in sections:
+            try:
+                if table_strategy == 'retrieve':
+                    retrieval_section(prompt, file_contents, filetype, budget, sheets, table_format)
+                    sections[key] = None
+                else:
+                    sections[key] = file_section(file_contents, filetype, budget, table_strategy, table_format, sheets)
+            except Exception as e:
+                sections[key] = e
+
+    def run(index, prompt, file_contents, filetype):
+        start_time = time.perf_counter()
+        try:
+            if table_strategy == 'map_reduce':
+                # One request slot; the chunk calls are paced by cached_invoke's adaptive concurrency
+                waited = limiter.acquire()
+                result = map_reduce_event(prompt, file_contents, filetype, max_input_tokens, sheets)
+            else:
+                section = sections[(file_contents, filetype, input_budget(MAX_TOKENS, prompt, max_input_tokens))]
+                if isinstance(section, Exception):
+                    raise section
+                request_body, table_stats = build_request_body(prompt, file_contents, filetype, max_input_tokens,
+                                                               table_strategy, section=section, table_format=table_format,
+                                                               sheets=sheets)
+
+                # Reserve input plus maximum output tokens against the per-minute quota
+                content = request_body["messages"][0]["content"]
+                tokens = sum(estimate_tokens(block["text"]) for block in content) + MAX_TOKENS
+                waited = limiter.acquire(tokens)
+                result = invoke_request(request_body, table_stats)
+        except Exception as e:
+            logging.error(f"Error in batch job {index}: {str(e)}")
+            result, waited = {'error': str(e)}, 0.0
+
+        result.update({
+            'index': index,
+            'prompt': prompt,
+            'latency': time.perf_counter() - start_time,
+            'rate_limit_wait': waited,
+        })
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(bind(run), index, *job) for index, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            yield future.result()
@@ -4,15 +4,20 @@ import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
-import boto3
-import openpyxl
-import csv
-import io
+from clients import get_client
+from table_text import table_text_for, input_budget
+from streaming import ResponseStream
+from prompt_cache import cached_text_block
+from conversation import Conversation
 import base64
-import json
+import hashlib
 import logging
 from io import BytesIO
 from streamlit_chat import message
+from ingest import is_excel
+from sql_mode import load_sqlite, answer_with_sql
+from profiling import cached_profile
+from dataframes import load_dataframe, render_preview
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -28,137 +33,191 @@ if 'generated' not in st.session_state:
     st.session_state['generated'] = []
 if 'past' not in st.session_state:
     st.session_state['past'] = []
-if 'messages' not in st.session_state:
-    st.session_state['messages'] = [
-        {"role": "system", "content": "You are a helpful assistant."}
-    ]
+if 'conversation' not in st.session_state:
+    # Turns sent back to the model: a token window of recent turns plus a running summary
+    st.session_state['conversation'] = Conversation()
+    st.session_state['conversation_upload'] = None
+
+if 'ingested' not in st.session_state:
+    st.session_state['ingested'] = {}
+if 'upload_hashes' not in st.session_state:
+    st.session_state['upload_hashes'] = {}
+
+# Number of parsed uploads kept per session
+MAX_INGESTED_UPLOADS = 3
+
+# Parse an upload once per session, keyed by its content hash
+def ingest_upload(uploaded_file):
+    # Hash each upload once; reruns look the digest up by Streamlit's file id
+    file_id = getattr(uploaded_file, 'file_id', None)
+    digest = st.session_state['upload_hashes'].get(file_id) if file_id else None
+    if digest is None:
+        digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        if file_id:
+            st.session_state['upload_hashes'][file_id] = digest
+
+    ingested = st.session_state['ingested']
+    entry = ingested.get(digest)
+    if entry is None:
+        file_contents = uploaded_file.getvalue()
+        filetype = uploaded_file.type.split('/')[-1] if uploaded_file.type else uploaded_file.name.split('.')[-1]
+        if not is_excel(filetype):
+            filetype = 'csv'
+        # Arrow-backed columns when pyarrow is installed; load time and memory are shown with the preview
+        dataframe, load_stats = load_dataframe(file_contents, filetype)
+
+        logging.debug(f"Parsed upload {digest[:12]} ({len(file_contents)} bytes)")
+        entry = {
+            'digest': digest,
+            'filetype': filetype,
+            'dataframe': dataframe,
+            'load_stats': load_stats,
+            'data_text': None,
+            'quality': None,
+            'sqlite': None,
+        }
+        ingested[digest] = entry
+        while len(ingested) > MAX_INGESTED_UPLOADS:
+            ingested.pop(next(iter(ingested)))
+    return entry
+
+# Serialized prompt text for an upload, built on the first question
+def upload_data_text(entry, uploaded_file):
+    if entry['data_text'] is None:
+        entry['data_text'] = table_text_for(uploaded_file.getvalue(), entry['filetype'], input_budget(900))[0]
+    return entry['data_text']
+
+# In-memory SQLite copy of an upload for SQL mode, built once
+def upload_sqlite(entry):
+    if entry['sqlite'] is None:
+        entry['sqlite'] = load_sqlite(entry['dataframe'])
+    return entry['sqlite']
+
+# Data quality profile for an upload, computed once per upload hash (sampled for large files)
+def quality_check(entry):
+    if entry['quality'] is None:
+        entry['quality'] = cached_profile(entry['digest'], entry['dataframe'])
+    return entry['quality']
 
 # Allow user to upload CSV file
 uploaded_file = st.file_uploader("Choose a file")
+upload = None
+sql_mode = False
 
 if uploaded_file is not None:
-    # Read uploaded file as a Pandas DataFrame
-    dataframe = pd.read_csv(uploaded_file)
-    st.write(dataframe)
+    # Read uploaded file as a Pandas DataFrame (parsed once per upload)
+    upload = ingest_upload(uploaded_file)
+    if st.session_state['conversation_upload'] != upload['digest']:
+        # A different file starts a new conversation (its prefix and summary no longer apply)
+        st.session_state['conversation'] = Conversation()
+        st.session_state['conversation_upload'] = upload['digest']
+    dataframe = upload['dataframe']
+    # Only the visible page of rows is sent to the browser
+    render_preview(dataframe, upload['load_stats'], key=upload['digest'][:12])
+    sql_mode = st.checkbox('Answer with SQL (best for sums, counts and group-bys)')
     data_quality_check = st.checkbox('Request Data Quality Check')
     
     if data_quality_check:
+        quality = quality_check(upload)
         st.write("The following data quality analysis has been made")
         st.markdown("**1. The dataset column names have been checked for trailing spaces**")
-        trailing_spaces = dataframe.columns[dataframe.columns.str.contains("\s+$", regex=True)]
-        if trailing_spaces.empty:
+        if not quality['trailing_spaces']:
             st.markdown('*Columns_ names_ are_ found_ ok*')
         else:
             st.markdown("*Columns with trailing spaces:* ")
-            st.write(f"{', '.join(trailing_spaces)}")
+            st.write(f"{', '.join(map(str, quality['trailing_spaces']))}")
 
         # Check data type of columns with name 'date'
         st.markdown("**2. The dataset's date columns have been checked for the correct data type**")
-        date_cols = dataframe.select_dtypes(include="object").filter(regex="(?i)date").columns
-        for col in date_cols:
-            if pd.to_datetime(dataframe[col], errors="coerce").isna().sum() > 0:
+        for col in quality['date_cols']:
+            if col in quality['bad_date_cols']:
                 st.write(f"Column {col} should contain dates but has wrong data type")
             else:
                 st.write("Columns with date are of the correct data type")
-        st.markdown("**:red[CSV BOT recommends fixing data quality issues prior to querying your data]**")
-
-# Define function to generate response from user input using AWS Bedrock Claude model
-def generate_response(prompt, file_contents=None, filetype=None):
-    try:
-        logging.debug(f"Prompt: {prompt}")
-        logging.debug(f"Filetype: {filetype}")
-
-        if file_contents:
-            logging.debug("Processing file contents...")
-            if filetype.lower() in ['xlsx', 'xls', "vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                # Read Excel file
-                excel_file = BytesIO(file_contents)
-                workbook = openpyxl.load_workbook(excel_file)
-                sheet = workbook.active
-
-                # Process Excel data
-                excel_info = []
-                for row in sheet.iter_rows(values_only=True):
-                    excel_info.append(list(row))
-
-                # Convert Excel data to a readable string format
-                excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
-                logging.debug(f"Excel data text: {excel_data_text}")
-
-                # Add Excel data as text to the request body
-                prompt += f"\ndata:\n{excel_data_text}"
-
-            elif filetype.lower() == 'csv':
-                # Read CSV file
-                csv_data = file_contents.decode('utf-8')
-                csv_reader = csv.reader(io.StringIO(csv_data))
-
-                # Process CSV rows
-                csv_info = []
-                for row in csv_reader:
-                    csv_info.append(row)
-
-                # Convert CSV data to a readable string format
-                csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
-                logging.debug(f"CSV data text: {csv_data_text}")
-
-                # Add CSV data as text to the request body
-                prompt += f"\ndata:\n{csv_data_text}"
-
-            else:
-                logging.debug(f"Unhandled file type: {filetype}")
-
-        prompt += "Retrieve information from the DataFrame based on the given query if it involves manipulation. The answer should be in three lines. Do not provide any code."
-
-        # Create a request body for Bedrock
-        request_body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 900,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
-                }
-            ]
-        }
-
-        logging.debug(f"Request Body: {json.dumps(request_body)}")
-
-        # Create a Bedrock runtime client
-        client = boto3.client('bedrock-runtime')
-
-        # Set the model ID for Claude 3 Sonnet
-        model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        logging.debug(f"Response Payload: {response_payload}")
-
-        payload = json.loads(response_payload)
-        generated_text = payload.get('completions', [{}])[0].get('text', '')
-
-        # Return the generated text
-        return {
-            'generated_text': generated_text,
-            'response': payload
-        }
+        st.markdown("**3. Column profile**")
+        sampled = ""
+        if quality['sampled_rows'] < quality['rows']:
+            sampled = f" (types, distinct values and outliers from a sample of {quality['sampled_rows']:,})"
+        st.caption(f"{quality['rows']:,} rows{sampled} | profiled in {quality['seconds']:.2f}s")
+        st.dataframe(pd.DataFrame([
+            {
+                'column': name,
+                'type': info['type'],
+                'null %': round(info['null_rate'] * 100, 2),
+                'distinct': info['distinct'],
+                'outlier %': round(info['outlier_rate'] * 100, 2) if 'outlier_rate' in info else None,
+                'date parse %': round(info['date_parse_rate'] * 100, 2) if 'date_parse_rate' in info else None,
+            }
+            for name, info in quality['columns'].items()
+        ]))
+        st.markdown("**:red[CSV BOT recommends fixing data quality issues prior to querying your data]**")
 
-    except Exception as e:
-        logging.error(f"Error: {str(e)}")
-        return {
-            'error': str(e)
-        }
+# Model ID for Claude 3 Sonnet
+model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+# Answer instructions; sent with the file contents as the stable, cached start of every request
+INSTRUCTIONS = "Retrieve information from the DataFrame based on the given query if it involves manipulation. The answer should be in three lines. Do not provide any code."
+
+# Build the Bedrock request body for a question about the uploaded file
+def build_request_body(prompt, data_text=None, conversation=None):
+    # data_text is the upload's serialized file text (see upload_data_text), or None without an upload
+    # Instructions and file contents are identical on every turn, so they go first as a
+    # cached prefix; the conversation adds its summary and recent turns after it
+    system_text = INSTRUCTIONS if data_text is None else f"{INSTRUCTIONS}\ndata:\n{data_text}"
+    system = [cached_text_block(system_text)]
+    if conversation is not None:
+        system += conversation.summary_blocks()
+        messages = conversation.messages(prompt)
+    else:
+        messages = [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": prompt
+                    }
+                ]
+            }
+        ]
+
+    # Create a request body for Bedrock
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 900,
+        "system": system,
+        "messages": messages
+    }
+
+# Stream the answer back as text deltas
+def stream_response(prompt, filetype=None, data_text=None, conversation=None):
+    logging.debug(f"Prompt: {prompt}")
+    logging.debug(f"Filetype: {filetype}")
+
+    request_body = build_request_body(prompt, data_text, conversation)
+    return ResponseStream(get_client('bedrock-runtime'), model_id, request_body)
+
+# Stream an answer about the uploaded file and store it in the chat history
+def answer_streamed(user_input):
+    # Reuse the serialized file text from the upload cache
+    data_text = upload_data_text(upload, uploaded_file) if upload else None
+    filetype = upload['filetype'] if upload else None
+    conversation = st.session_state['conversation']
+    stream = stream_response(user_input, filetype, data_text, conversation)
+
+    # Render tokens as they arrive, then hand the answer over to the chat history
+    stream_placeholder = st.empty()
+    for _ in stream:
+        stream_placeholder.markdown(stream.text)
+    stream_placeholder.empty()
+
+    st.session_state['past'].append(user_input)
+    st.session_state['generated'].append(stream.text)
+    conversation.add_turn(user_input, stream.text)
+    first_token = stream.metrics['time_to_first_token'] or 0.0
+    st.caption(f"Time to first token: {first_token:.2f}s | Total time: {stream.metrics['total_time']:.2f}s"
+               f" | Input tokens: {stream.metrics['input_tokens']} (cached: {stream.metrics['cache_read_input_tokens']})")
 
 # container for chat history
 response_container = st.container()
@@ -175,11 +234,16 @@ with input_container:
     if submit_button and user_input:
         # If user submits input, generate response and store input and response in session state variables
         try:
-            file_contents = uploaded_file.getvalue() if uploaded_file else None
-            filetype = uploaded_file.type if uploaded_file else None
-            query_response = generate_response(user_input, file_contents, filetype)
-            st.session_state['past'].append(user_input)
-            st.session_state['generated'].append(query_response['generated_text'])
+            if upload and sql_mode:
+                # Send only the schema and sample rows; the query runs locally
+                result = answer_with_sql(get_client('bedrock-runtime'), model_id, user_input,
+                                         upload_sqlite(upload), upload['dataframe'])
+                st.session_state['past'].append(user_input)
+                st.session_state['generated'].append(result['generated_text'])
+                st.session_state['conversation'].add_turn(user_input, result['generated_text'])
+                st.caption(f"SQL: {result['sql']} | Total time: {result['timings']['total_seconds']:.2f}s")
+            else:
+                answer_streamed(user_input)
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
 
@@ -189,3 +253,6 @@ if st.session_state['generated']:
         for i in range(len(st.session_state['generated'])):
             message(st.session_state["past"][i], is_user=True, key=str(i) + '_user')
             message(st.session_state["generated"][i], key=str(i))
+
+# Fold older turns into the summary only now, with the chat history (and the new answer) on screen
+st.session_state['conversation'].compact(get_client('bedrock-runtime'))
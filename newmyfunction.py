@@ -1,55 +1,44 @@
-import boto3
-import openpyxl
-import csv
-import io
-from io import BytesIO
+from clients import get_client
+from response_cache import cached_invoke
+from prompt_cache import cached_text_block, cache_usage
+from table_text import table_text_for, input_budget
+from tracing import traced, span
 import base64
 import json
 import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Fixed instructions sent with every question; they go first so they are part of the cached prefix
+INSTRUCTIONS = "Gets the information from the given Query from the Dataframe, if the query is realted to manipulation and the answer should be in 3 lines don't provide any code"
+
+@traced('process_event')
 def process_event(prompt, file_contents, filetype):
     try:
         logging.debug(f"Prompt: {prompt}")
         logging.debug(f"Filetype: {filetype}")
 
+        # Token budget for the file contents (answer uses up to 900 tokens)
+        budget = input_budget(900, prompt + INSTRUCTIONS)
+        file_text = ''
+
         if file_contents:
             logging.debug("Processing file contents...")
             if filetype.lower() in ['xlsx', 'xls',"vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-                # Read Excel file
-                excel_file = BytesIO(file_contents)
-                workbook = openpyxl.load_workbook(excel_file)
-                sheet = workbook.active
-
-                # Process Excel data
-                excel_info = []
-                for row in sheet.iter_rows(values_only=True):
-                    excel_info.append(list(row))
-
-                # Convert Excel data to a readable string format
-                excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
+                # Stream the Excel rows into a readable string format within the token budget
+                excel_data_text = table_text_for(file_contents, filetype, budget)[0]
                 logging.debug(f"Excel data text: {excel_data_text}")
 
                 # Add Excel data as text to the request body
-                prompt += f"\ndata frame:\n{excel_data_text}"
+                file_text = f"\ndata frame:\n{excel_data_text}"
 
             elif filetype.lower() == 'csv':
-                # Read CSV file
-                csv_data = file_contents.decode('utf-8')
-                csv_reader = csv.reader(io.StringIO(csv_data))
-
-                # Process CSV rows
-                csv_info = []
-                for row in csv_reader:
-                    csv_info.append(row)
-
-                # Convert CSV data to a readable string format
-                csv_data_text = "\n".join([", ".join(map(str, row)) for row in csv_info])
+                # Stream the CSV rows into a readable string format within the token budget
+                csv_data_text = table_text_for(file_contents, filetype, budget)[0]
                 logging.debug(f"CSV data text: {csv_data_text}")
 
                 # Add CSV data as text to the request body
-                prompt += f"\nData Frame:\n{csv_data_text}"
+                file_text = f"\nData Frame:\n{csv_data_text}"
             
             else:
                 logging.debug(f"Unhandled file type: {filetype}")
@@ -57,25 +46,20 @@ def process_event(prompt, file_contents, filetype):
         else:
             logging.debug("No file contents provided, using S3 file.")
             # Simulate fetching a file from S3 if no file is uploaded
-            s3_client = boto3.client('s3')
+            s3_client = get_client('s3')
             bucket_name = 'bedrocktest03'
             file_key = 'Employee_Details-2.xlsx'  # Adjust file extension based on 'filetype'
-            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-            file_data = s3_object['Body'].read()
+            with span('s3_fetch'):
+                s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+                file_data = s3_object['Body'].read()
 
             # Assume the file is an Excel file for this example
-            excel_file = BytesIO(file_data)
-            workbook = openpyxl.load_workbook(excel_file)
-            sheet = workbook.active
-            excel_info = []
-            for row in sheet.iter_rows(values_only=True):
-                excel_info.append(list(row))
-            excel_data_text = "\n".join([", ".join(map(str, row)) for row in excel_info])
+            excel_data_text = table_text_for(file_data, 'xlsx', budget)[0]
             logging.debug(f"Excel data text from S3: {excel_data_text}")
-            prompt += f"\nExcel file contents:\n{excel_data_text}"
-        
-        prompt += "Gets the information from the given Query from the Dataframe, if the query is realted to manipulation and the answer should be in 3 lines don't provide any code"
-        # Create a request body for Bedrock
+            file_text = f"\nExcel file contents:\n{excel_data_text}"
+
+        # Create a request body for Bedrock: instructions and file contents are the
+        # same for every question about a file, so they form a cacheable prefix
         request_body = {
             "anthropic_version": "bedrock-2023-05-31",
             "max_tokens": 900,
@@ -83,6 +67,7 @@ def process_event(prompt, file_contents, filetype):
                 {
                     "role": "user",
                     "content": [
+                        cached_text_block(INSTRUCTIONS + file_text),
                         {
                             "type": "text",
                             "text": prompt
@@ -94,29 +79,23 @@ def process_event(prompt, file_contents, filetype):
 
         logging.debug(f"Request Body: {json.dumps(request_body)}")
 
-        # Create a Bedrock runtime client (replace with your region)
-        client = boto3.client('bedrock-runtime', region_name='us-east-1')
+        # Get the shared Bedrock runtime client (replace with your region)
+        client = get_client('bedrock-runtime', region_name='us-east-1')
 
         # Set the model ID for Claude 3 Sonnet
         model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-        # Send the request to Bedrock using the 'invoke' API method
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
-
-        # Read the content from the StreamingBody
-        response_payload = response['body'].read().decode('utf-8')
-        logging.debug(f"Response Payload: {response_payload}")
+        # Send the request to Bedrock (cache checkpoints are dropped for models without prompt caching)
+        payload = cached_invoke(client, model_id, request_body)
+        logging.debug(f"Response Payload: {json.dumps(payload)}")
 
-        payload = json.loads(response_payload)
         generated_text = payload.get('completions', [{}])[0].get('text', '')
 
         # Return the generated text
         return {
             'generated_text': generated_text,
-            'response': payload
+            'response': payload,
+            'prompt_cache': cache_usage(payload)
         }
 
     except Exception as e:
@@ -0,0 +1,168 @@
+# Column profiling for the data quality check.
+# One pass over the table (a DataFrame or its chunks) counts nulls exactly
+# and keeps a uniform reservoir sample of at most SAMPLE_ROWS rows; type
+# inference, cardinality, outliers and date parsability are computed on the
+# sample, so a million-row upload is profiled in about the time of a small
+# one. Profiles are cached per upload hash.
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+SAMPLE_ROWS = int(os.environ.get('PROFILE_SAMPLE_ROWS', '20000'))
+
+# Text columns with at most this share of distinct values are reported as categorical
+CATEGORICAL_RATIO = 0.05
+
+# Share of parsable values needed to call a text column numeric or dates
+PARSE_THRESHOLD = 0.9
+
+# Values beyond this many interquartile ranges from the quartiles count as outliers
+IQR_FACTOR = 1.5
+
+MAX_PROFILES = int(os.environ.get('PROFILE_CACHE_SIZE', '8'))
+
+_profiles = OrderedDict()
+_lock = threading.Lock()
+
+
+def reservoir_sample(chunks, size=SAMPLE_ROWS, seed=0):
+    # Uniform sample of size rows from an iterable of DataFrame chunks, in one pass:
+    # every row gets a random key and the rows with the smallest keys are kept
+    rng = np.random.default_rng(seed)
+    reservoir, keys = None, None
+    for chunk in chunks:
+        chunk_keys = rng.random(len(chunk))
+        if reservoir is not None:
+            chunk = pd.concat([reservoir, chunk], ignore_index=True)
+            chunk_keys = np.concatenate([keys, chunk_keys])
+        if len(chunk) > size:
+            keep = np.argpartition(chunk_keys, size)[:size]
+            chunk, chunk_keys = chunk.iloc[keep].reset_index(drop=True), chunk_keys[keep]
+        reservoir, keys = chunk, chunk_keys
+    return reservoir
+
+
+def _is_text(column):
+    return pd.api.types.is_object_dtype(column) or pd.api.types.is_string_dtype(column)
+
+
+def _parse_dates(column):
+    # Date parsing without per-value format guessing warnings; all NaT when pandas cannot parse
+    try:
+        return pd.to_datetime(column, errors='coerce', format='mixed')
+    except (TypeError, ValueError):
+        return pd.Series(pd.NaT, index=column.index)
+
+
+def profile(data, sample_rows=SAMPLE_ROWS):
+    # Per-column profile and table-level findings for a DataFrame or an iterable of chunks
+    start_time = time.perf_counter()
+    null_counts, rows = 0, 0
+
+    def counted(chunks):
+        # Exact null counts over every row while the sample is drawn
+        nonlocal null_counts, rows
+        for chunk in chunks:
+            null_counts = chunk.isna().sum() + null_counts
+            rows += len(chunk)
+            yield chunk
+
+    sample = reservoir_sample(counted([data] if isinstance(data, pd.DataFrame) else data), sample_rows)
+    if sample is None:
+        raise ValueError('Nothing to profile')
+    null_rates = null_counts / rows if rows else pd.Series(0.0, index=sample.columns)
+    present = sample.notna().sum()
+    distinct = sample.nunique(dropna=True)
+
+    # Numeric view of each column: native numbers as they are, text parsed where possible
+    numeric = pd.DataFrame(index=sample.index)
+    columns = {}
+    for name in sample.columns:
+        column = sample[name]
+        info = {
+            'null_rate': float(null_rates[name]),
+            'distinct': int(distinct[name]),
+            'distinct_ratio': float(distinct[name] / present[name]) if present[name] else 0.0,
+        }
+        if present[name] == 0:
+            info['type'] = 'empty'
+        elif pd.api.types.is_bool_dtype(column):
+            info['type'] = 'boolean'
+        elif pd.api.types.is_numeric_dtype(column):
+            info['type'] = 'numeric'
+            numeric[name] = column
+        elif pd.api.types.is_datetime64_any_dtype(column):
+            info['type'] = 'datetime'
+            info['date_parse_rate'] = 1.0
+        elif _is_text(column):
+            values = column.dropna().astype(str).str.strip()
+            parsed = pd.to_numeric(values, errors='coerce')
+            numeric_rate = float(parsed.notna().mean())
+            if numeric_rate >= PARSE_THRESHOLD:
+                info['type'] = 'numeric'
+                info['numeric_parse_rate'] = numeric_rate
+                numeric[name] = parsed.reindex(sample.index)
+            else:
+                date_rate = float(_parse_dates(values).notna().mean())
+                info['date_parse_rate'] = date_rate
+                if date_rate >= PARSE_THRESHOLD:
+                    info['type'] = 'datetime'
+                elif info['distinct_ratio'] <= CATEGORICAL_RATIO:
+                    info['type'] = 'categorical'
+                else:
+                    info['type'] = 'text'
+            info['trailing_spaces'] = float((values.str.len() != column.dropna().astype(str).str.len()).mean())
+        else:
+            info['type'] = str(column.dtype)
+        columns[str(name)] = info
+
+    # Outliers for all numeric columns at once (interquartile-range rule)
+    if not numeric.empty:
+        numeric = numeric.astype(float)
+        q1, q3 = numeric.quantile(0.25), numeric.quantile(0.75)
+        spread = (q3 - q1) * IQR_FACTOR
+        outliers = ((numeric < q1 - spread) | (numeric > q3 + spread)).sum() / numeric.notna().sum()
+        for name in numeric.columns:
+            info = columns[str(name)]
+            info['outlier_rate'] = float(outliers[name]) if numeric[name].notna().any() else 0.0
+            info['min'], info['max'] = float(numeric[name].min()), float(numeric[name].max())
+
+    names = [str(name) for name in sample.columns]
+    # Text and datetime columns named like dates; those whose values do not all parse as
+    # dates are bad. Without a date_parse_rate (e.g. all empty, or text that parses as
+    # numbers) the check does not apply
+    date_cols = [str(name) for name in sample.columns if 'date' in str(name).lower()
+                 and (_is_text(sample[name]) or pd.api.types.is_datetime64_any_dtype(sample[name]))]
+    result = {
+        'rows': rows,
+        'sampled_rows': len(sample),
+        'columns': columns,
+        'trailing_spaces': [name for name in names if name != name.rstrip()],
+        'date_cols': date_cols,
+        'bad_date_cols': [name for name in date_cols
+                          if columns[name].get('date_parse_rate', 1.0) < 1.0],
+        'seconds': time.perf_counter() - start_time,
+    }
+    logging.debug(f"Profiled {rows} rows ({len(sample)} sampled) in {result['seconds']:.2f}s")
+    return result
+
+
+def cached_profile(digest, data, sample_rows=SAMPLE_ROWS):
+    # Profile once per upload hash; reruns and other sessions with the same file reuse it
+    with _lock:
+        result = _profiles.get(digest)
+        if result is not None:
+            _profiles.move_to_end(digest)
+            return result
+    result = profile(data, sample_rows)
+    with _lock:
+        _profiles[digest] = result
+        while len(_profiles) > MAX_PROFILES:
+            _profiles.popitem(last=False)
+    return result
@@ -0,0 +1,194 @@
+# Bedrock prompt caching.
+# Request builders put static content (instructions, file contents) first
+# and mark the end of that prefix as a cache checkpoint, so a model with
+# prompt caching reads the prefix from its cache instead of processing it
+# again. Checkpoints are stripped for models without prompt caching, and
+# PromptCacheStub simulates cache hits locally.
+
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+
+from table_text import estimate_tokens
+
+# auto: only for models known to support prompt caching; true / false force it
+PROMPT_CACHE = os.environ.get('PROMPT_CACHE', 'auto').lower()
+
+# Model ID prefixes with prompt caching on Bedrock (Claude 3 Sonnet has none)
+CACHE_MODELS = (
+    'anthropic.claude-3-5-haiku',
+    'anthropic.claude-3-7-sonnet',
+    'anthropic.claude-sonnet-4',
+    'anthropic.claude-opus-4',
+    'amazon.nova',
+)
+
+# Shortest prefix Bedrock caches, in tokens; a checkpoint after a shorter prefix
+# is never hit (Claude 3.5 Haiku needs twice the usual minimum)
+MIN_CACHE_TOKENS = int(os.environ.get('PROMPT_CACHE_MIN_TOKENS', '1024'))
+MODEL_MIN_CACHE_TOKENS = {'anthropic.claude-3-5-haiku': 2048}
+
+# Cross-region inference profile prefixes, e.g. us.anthropic.claude-...
+REGION_PREFIXES = ('us', 'eu', 'apac', 'global')
+
+# invoke_model marks the last block of the prefix; converse inserts a cache point block
+CACHE_CONTROL = {"type": "ephemeral"}
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+stats = {'requests': 0, 'cache_read_input_tokens': 0, 'cache_write_input_tokens': 0}
+_lock = threading.Lock()
+
+
+def _base_model(model_id):
+    prefix, _, rest = model_id.partition('.')
+    return rest if prefix in REGION_PREFIXES else model_id
+
+
+def supports_prompt_cache(model_id):
+    if PROMPT_CACHE in ('true', 'false'):
+        return PROMPT_CACHE == 'true'
+    return _base_model(model_id).startswith(CACHE_MODELS)
+
+
+def min_cache_tokens(model_id):
+    base = _base_model(model_id)
+    return next((tokens for prefix, tokens in MODEL_MIN_CACHE_TOKENS.items() if base.startswith(prefix)),
+                MIN_CACHE_TOKENS)
+
+
+def prefix_blocks(model_id, text):
+    # converse blocks for a static prefix, ending in a cache point only when the
+    # prefix is long enough for Bedrock to cache it
+    blocks = [{"text": text}]
+    if estimate_tokens(text) >= min_cache_tokens(model_id):
+        blocks.append(CACHE_POINT)
+    return blocks
+
+
+def cached_text_block(text):
+    # Messages API text block that ends a cacheable prefix
+    return {"type": "text", "text": text, "cache_control": CACHE_CONTROL}
+
+
+def prepare_body(model_id, request_body):
+    # invoke_model body as sent: cache_control removed when the model has no prompt caching
+    if supports_prompt_cache(model_id):
+        return request_body
+
+    def strip(blocks):
+        if not isinstance(blocks, list):
+            return blocks
+        return [{k: v for k, v in block.items() if k != 'cache_control'} if isinstance(block, dict) else block
+                for block in blocks]
+
+    body = dict(request_body)
+    if 'system' in body:
+        body['system'] = strip(body['system'])
+    body['messages'] = [dict(message, content=strip(message['content'])) for message in body.get('messages', [])]
+    return body
+
+
+def prepare_blocks(model_id, blocks):
+    # converse messages/system blocks as sent: cache points removed when unsupported
+    if supports_prompt_cache(model_id):
+        return blocks
+    return [block for block in blocks if 'cachePoint' not in block]
+
+
+def cache_usage(payload):
+    # Cache read/write input tokens from an invoke_model or converse response
+    usage = payload.get('usage') or {}
+    return {
+        'cache_read_input_tokens': usage.get('cache_read_input_tokens', usage.get('cacheReadInputTokens')) or 0,
+        'cache_write_input_tokens': usage.get('cache_creation_input_tokens', usage.get('cacheWriteInputTokens')) or 0,
+    }
+
+
+def record(payload):
+    usage = cache_usage(payload)
+    with _lock:
+        stats['requests'] += 1
+        for name, tokens in usage.items():
+            stats[name] += tokens
+    return usage
+
+
+class PromptCacheStub:
+    # Local stand-in for the bedrock-runtime client: every prefix ending at a
+    # checkpoint is "written" on first use and "read" on later requests within ttl
+
+    def __init__(self, reply='Stub response', ttl=300, min_tokens=MIN_CACHE_TOKENS):
+        self.reply = reply
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self._prefixes = {}  # prefix hash -> expires_at
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, **kwargs):
+        request = json.loads(body)
+        reply = self.response_text(request.get('max_tokens'))
+        system = request.get('system') or []
+        blocks = [{'type': 'text', 'text': system}] if isinstance(system, str) else list(system)
+        for message in request.get('messages', []):
+            content = message['content']
+            blocks += content if isinstance(content, list) else [{'type': 'text', 'text': content}]
+        checkpoints = [i + 1 for i, block in enumerate(blocks) if 'cache_control' in block]
+        read, write, total = self._simulate(blocks, checkpoints)
+        payload = {
+            'type': 'message',
+            'role': 'assistant',
+            'content': [{'type': 'text', 'text': reply}],
+            'stop_reason': 'end_turn',
+            'usage': {
+                'input_tokens': total - read - write,
+                'output_tokens': estimate_tokens(reply),
+                'cache_read_input_tokens': read,
+                'cache_creation_input_tokens': write,
+            },
+        }
+        return {'body': io.BytesIO(json.dumps(payload).encode('utf-8'))}
+
+    def converse(self, modelId, messages, system=None, inferenceConfig=None, **kwargs):
+        reply = self.response_text((inferenceConfig or {}).get('maxTokens'))
+        blocks = list(system or [])
+        for message in messages:
+            blocks += message['content']
+        checkpoints = [i for i, block in enumerate(blocks) if 'cachePoint' in block]
+        read, write, total = self._simulate(blocks, checkpoints)
+        return {
+            'output': {'message': {'role': 'assistant', 'content': [{'text': reply}]}},
+            'stopReason': 'end_turn',
+            'usage': {
+                'inputTokens': total - read - write,
+                'outputTokens': estimate_tokens(reply),
+                'cacheReadInputTokens': read,
+                'cacheWriteInputTokens': write,
+            },
+        }
+
+    def response_text(self, max_tokens):
+        return self.reply
+
+    def _simulate(self, blocks, checkpoints):
+        # Return (cache read tokens, cache write tokens, total input tokens)
+        def tokens(part):
+            return sum(estimate_tokens(block.get('text', '')) for block in part)
+
+        now = time.time()
+        read = write = 0
+        with self._lock:
+            for end in checkpoints:
+                prefix_tokens = tokens(blocks[:end])
+                if prefix_tokens < self.min_tokens:
+                    continue
+                key = hashlib.sha256(json.dumps(blocks[:end], sort_keys=True).encode('utf-8')).hexdigest()
+                if self._prefixes.get(key, 0) > now:
+                    read = prefix_tokens
+                    write = 0
+                else:
+                    write = prefix_tokens - read
+                self._prefixes[key] = now + self.ttl
+        return read, write, tokens(blocks)
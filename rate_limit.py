@@ -0,0 +1,51 @@
+# Client-side token-bucket rate limiting for Bedrock calls, used to stay
+# under the account's requests-per-second and tokens-per-minute quotas.
+
+import threading
+import time
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+        # rate is units per second; capacity is the burst size
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount=1):
+        # Block until amount units are available; returns the time spent waiting
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class RateLimiter:
+
+    def __init__(self, requests_per_second=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_second) if requests_per_second else None
+        self.tokens = TokenBucket(tokens_per_minute / 60.0, tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens=0):
+        # Wait for one request slot and the given number of tokens
+        waited = 0.0
+        if self.requests:
+            waited += self.requests.acquire(1)
+        if self.tokens and tokens:
+            waited += self.tokens.acquire(tokens)
+        return waited
@@ -0,0 +1,206 @@
+# Content-addressed cache for Bedrock responses.
+# Keys are a hash of the model ID and the fully built request body (which
+# carries the inference parameters), so identical prompt+file requests are
+# answered from memory or /tmp instead of a new model call.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from prompt_cache import prepare_body, record
+from throttling import call_with_retry
+from tracing import span
+
+# Cache settings (override with environment variables)
+CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '256'))
+CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+CACHE_DIR = os.environ.get('RESPONSE_CACHE_DIR')  # e.g. /tmp/response-cache
+CACHE_MAX_DISK_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_DISK_BYTES', str(256 * 1024 * 1024)))
+
+
+def make_key(model_id, request_body):
+    data = json.dumps({'model_id': model_id, 'body': request_body}, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES,
+                 disk_dir=CACHE_DIR, max_disk_bytes=CACHE_MAX_DISK_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()  # key -> (expires_at, data)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, data = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return json.loads(data)
+                self._remove(key)
+
+        data = self._disk_get(key, now)
+        with self._lock:
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._store(key, data, now)
+        return json.loads(data)
+
+    def put(self, key, payload):
+        data = json.dumps(payload)
+        now = time.time()
+        with self._lock:
+            self._store(key, data, now)
+        self._disk_put(key, data)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # In-memory LRU tier
+
+    def _store(self, key, data, now):
+        if key in self._entries:
+            self._remove(key)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = (now + self.ttl, data)
+        self._bytes += len(data)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, data = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    # Optional on-disk tier (e.g. /tmp in Lambda), expiry by file mtime
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + '.json')
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            if os.path.getmtime(path) + self.ttl <= now:
+                os.remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _disk_put(self, key, data):
+        if not self.disk_dir:
+            return
+        try:
+            tmp_path = self._path(key) + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self._disk_evict()
+        except OSError as e:
+            logging.debug(f"Response cache disk write failed: {e}")
+
+    def _disk_evict(self):
+        # Drop the least recently written files once over the size cap
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith('.json'):
+                path = os.path.join(self.disk_dir, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.stats['evictions'] += 1
+
+
+# Process-wide cache shared by the handlers
+default_cache = ResponseCache()
+
+
+def cached_invoke(client, model_id, request_body, cache=None):
+    # invoke_model with a cache in front; returns the parsed response payload
+    cache = cache or default_cache
+    request_body = prepare_body(model_id, request_body)
+    key = make_key(model_id, request_body) if CACHE_ENABLED else None
+    if key:
+        payload = cache.get(key)
+        if payload is not None:
+            logging.debug(f"Response cache hit {key[:12]} {cache.stats}")
+            return payload
+
+    with span('request_encode'):
+        body = json.dumps(request_body)
+
+    # Throttles are retried with backoff inside the adaptive concurrency window
+    def invoke():
+        with span('model_invoke'):
+            response = client.invoke_model(
+                modelId=model_id,
+                body=body
+            )
+            data = response['body'].read()
+        with span('response_decode'):
+            return json.loads(data.decode('utf-8'))
+
+    payload = call_with_retry(invoke)
+    usage = record(payload)
+    if any(usage.values()):
+        logging.debug(f"Prompt cache: {usage}")
+
+    if key:
+        cache.put(key, payload)
+    return payload
+
+
+def response_text(payload):
+    # Text of a Messages API response payload
+    return "".join(block.get('text', '') for block in payload.get('content', []) if block.get('type', 'text') == 'text')
+
+
+def message_body(text, max_tokens):
+    # Single-turn Messages API request body
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": text
+                    }
+                ]
+            }
+        ]
+    }
@@ -0,0 +1,179 @@
+# Lexical (BM25) index over table rows for lookup-style questions.
+# Each row is a document made of its cell text plus the names of its
+# non-empty columns (weighted lower), so a question about one employee
+# sends the header and the few matching rows instead of the whole table.
+# Indexes are cached per file hash and can be saved as JSON for reuse.
+
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+
+from ingest import iter_rows
+from table_text import DEFAULT_FORMAT, TABLE_TOKEN_BUDGET, estimate_tokens, row_serializer
+from tracing import span, timed_rows
+
+# Rows returned per question
+TOP_K = int(os.environ.get('ROW_INDEX_TOP_K', '20'))
+
+# Weight of a column-name term relative to a cell-value term
+COLUMN_WEIGHT = float(os.environ.get('ROW_INDEX_COLUMN_WEIGHT', '0.5'))
+
+# Rows scoring below this fraction of the best match are dropped (terms that
+# occur in every row, like column names, only add noise)
+MIN_SCORE_RATIO = float(os.environ.get('ROW_INDEX_MIN_SCORE_RATIO', '0.1'))
+
+# Indexes kept in memory (one per file and sheet)
+MAX_INDEXES = int(os.environ.get('ROW_INDEX_MAX_INDEXES', '8'))
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(str(text).lower())
+
+
+class RowIndex:
+
+    def __init__(self, header, lines, postings, lengths):
+        self.header = header  # serialized header row
+        self.lines = lines  # serialized data rows, in file order
+        self.postings = postings  # term -> [[row number, weighted term frequency], ...]
+        self.lengths = lengths  # weighted length of each row
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    @classmethod
+    def build(cls, rows, table_format=None, column_weight=COLUMN_WEIGHT):
+        # Rows are written in the same table format as the other strategies;
+        # terms come from the raw cell values
+        header, columns = None, []
+        lines, lengths, postings = [], [], {}
+        with span('index_build'):
+            serialize, rows = row_serializer(timed_rows(rows), table_format)
+            for row in rows:
+                if header is None:
+                    header = serialize(row)
+                    columns = [tokenize(name) if name is not None else [] for name in row]
+                    continue
+                weights = Counter()
+                for i, value in enumerate(row):
+                    if value is None or value == '':
+                        continue
+                    for term in tokenize(value):
+                        weights[term] += 1.0
+                    for term in (columns[i] if i < len(columns) else []):
+                        weights[term] += column_weight
+                number = len(lines)
+                for term, weight in weights.items():
+                    postings.setdefault(term, []).append([number, weight])
+                lines.append(serialize(row))
+                lengths.append(sum(weights.values()))
+        return cls(header or '', lines, postings, lengths)
+
+    def search(self, question, top_k=None):
+        # Return (row number, score) pairs for the best matching rows
+        top_k = TOP_K if top_k is None else top_k
+        count = len(self.lines)
+        scores = Counter()
+        for term in set(tokenize(question)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for number, weight in posting:
+                norm = K1 * (1 - B + B * self.lengths[number] / (self.average_length or 1))
+                scores[number] += idf * weight * (K1 + 1) / (weight + norm)
+        hits = scores.most_common(top_k)
+        if not hits:
+            return hits
+        threshold = hits[0][1] * MIN_SCORE_RATIO
+        return [(number, score) for number, score in hits if score >= threshold]
+
+    def table_text(self, question, max_input_tokens=None, top_k=None):
+        # Header plus the matching rows in file order, kept within the budget; same stats as build_table_text
+        budget = TABLE_TOKEN_BUDGET if max_input_tokens is None else max_input_tokens
+        with span('retrieve'):
+            hits = self.search(question, top_k)
+
+        # Hits come best first, so the lowest scoring rows are the ones dropped
+        selected, used = [], estimate_tokens(self.header) + 1
+        for number, _ in hits:
+            line_tokens = estimate_tokens(self.lines[number]) + 1
+            if used + line_tokens > budget:
+                break
+            selected.append(number)
+            used += line_tokens
+        selected.sort()
+
+        text = "\n".join([self.header] + [self.lines[number] for number in selected])
+        return text, {
+            'strategy': 'retrieve',
+            'budget_tokens': budget,
+            'estimated_tokens': estimate_tokens(text),
+            'rows_included': len(selected) + 1,
+            'rows_total': len(self.lines) + 1,
+            'truncated': len(selected) < len(self.lines),
+            'matches': len(hits),
+        }
+
+    def to_dict(self):
+        return {'header': self.header, 'lines': self.lines, 'postings': self.postings, 'lengths': self.lengths}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['header'], data['lines'], data['postings'], data['lengths'])
+
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def cached_index(cache_key, build):
+    # Return the index for cache_key, building it with build() on a miss
+    with _lock:
+        index = _indexes.get(cache_key)
+        if index is not None:
+            _indexes.move_to_end(cache_key)
+            return index
+    index = build()
+    with _lock:
+        _indexes[cache_key] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def index_for(file_data, filetype, sheet=None, table_format=None):
+    # Index of one sheet (default: the active one) or a CSV file, cached by content hash
+    digest = hashlib.sha256(file_data).hexdigest()
+    return cached_index((digest, filetype.lower(), sheet, table_format or DEFAULT_FORMAT),
+                        lambda: RowIndex.build(iter_rows(file_data, filetype, sheet), table_format))
+
+
+def clear_indexes():
+    with _lock:
+        _indexes.clear()
+
+
+if __name__ == '__main__':
+    # Usage: python row_index.py <file.xlsx|file.csv> <index.json> ["question"]
+    import json
+    import sys
+    import time
+
+    path, index_path = sys.argv[1], sys.argv[2]
+    with open(path, 'rb') as f:
+        data = f.read()
+    start_time = time.perf_counter()
+    index = RowIndex.build(iter_rows(data, path.rsplit('.', 1)[-1]))
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(index.to_dict(), f)
+    print(f"Indexed {len(index.lines)} rows, {len(index.postings)} terms in {time.perf_counter() - start_time:.2f}s")
+    if len(sys.argv) > 3:
+        print(index.table_text(sys.argv[3])[0])
@@ -0,0 +1,197 @@
+# /tmp-backed cache for S3 objects that survives across warm invocations.
+# Objects are revalidated with a conditional GET (If-None-Match) so an
+# unchanged object is not downloaded again, and the serialized table text
+# is kept next to the raw bytes so it is not re-parsed either.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from urllib.parse import unquote, urlparse
+
+from botocore.exceptions import ClientError
+
+from clients import get_client
+from tracing import span
+from table_text import table_text_for, DEFAULT_FORMAT
+from row_index import RowIndex, cached_index
+from ingest import iter_rows
+
+CACHE_DIR = os.environ.get('S3_CACHE_DIR', '/tmp/s3-cache')
+
+# Skip revalidation entirely for this many seconds after a check (0 = always revalidate)
+REVALIDATE_SECONDS = float(os.environ.get('S3_CACHE_REVALIDATE_SECONDS', '0'))
+
+# Objects are copied to /tmp in chunks of this many bytes, never held in memory whole
+CHUNK_SIZE = int(os.environ.get('S3_CACHE_CHUNK_SIZE', str(1024 * 1024)))
+
+stats = {'downloads': 0, 'not_modified': 0, 'fresh': 0, 'parses': 0, 'parse_hits': 0, 'index_builds': 0, 'index_hits': 0}
+
+
+def _base_path(bucket, key):
+    digest = hashlib.sha256(f'{bucket}/{key}'.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, digest)
+
+
+def _read_meta(base):
+    try:
+        with open(base + '.meta.json', 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _temp_file(mode='wb'):
+    # Unique temporary file in the cache directory, so concurrent writers of the same
+    # entry never share one; os.replace then swaps it in atomically
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    return tmp_path, os.fdopen(fd, mode)
+
+
+def _write_file(path, data, mode='wb'):
+    tmp_path, f = _temp_file(mode)
+    try:
+        with f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _download(body):
+    # Stream an object body to a new temporary file and return its path
+    tmp_path, f = _temp_file()
+    try:
+        with f:
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def _drop_parsed(base):
+    # Remove serialized tables and row indexes built from an older version of the object
+    prefixes = tuple(os.path.basename(base) + suffix for suffix in ('.table-', '.index-'))
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(prefixes):
+            os.remove(os.path.join(CACHE_DIR, name))
+
+
+def fetch_object(bucket, key, client=None):
+    # Return (etag, local path of the raw bytes), downloading only when changed
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    base = _base_path(bucket, key)
+    meta = _read_meta(base)
+    data_path = base + '.bin'
+    cached = meta is not None and os.path.exists(data_path)
+
+    if cached and time.time() - meta['checked_at'] < REVALIDATE_SECONDS:
+        stats['fresh'] += 1
+        return meta['etag'], data_path
+
+    client = client or get_client('s3')
+    request = {'Bucket': bucket, 'Key': key}
+    if cached:
+        request['IfNoneMatch'] = meta['etag']
+
+    try:
+        with span('s3_fetch'):
+            s3_object = client.get_object(**request)
+            tmp_path = _download(s3_object['Body'])
+    except ClientError as e:
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        if not cached or (status != 304 and e.response.get('Error', {}).get('Code') != '304'):
+            raise
+        # Not modified: keep the cached copy
+        stats['not_modified'] += 1
+        meta['checked_at'] = time.time()
+        _write_file(base + '.meta.json', json.dumps(meta), 'w')
+        return meta['etag'], data_path
+
+    stats['downloads'] += 1
+    os.replace(tmp_path, data_path)
+    if cached:
+        _drop_parsed(base)
+    meta = {'bucket': bucket, 'key': key, 'etag': s3_object['ETag'], 'checked_at': time.time()}
+    _write_file(base + '.meta.json', json.dumps(meta), 'w')
+    logging.debug(f"Downloaded s3://{bucket}/{key} ({meta['etag']})")
+    return meta['etag'], data_path
+
+
+def parse_s3_reference(reference):
+    # (bucket, key) from {"bucket": ..., "key": ...}, "s3://bucket/key" or an S3 object URL
+    # such as the presigned URL a file was uploaded to; None for anything else (e.g. file bytes)
+    bucket = key = None
+    if isinstance(reference, dict):
+        bucket, key = reference.get('bucket'), reference.get('key')
+    elif isinstance(reference, str):
+        url = urlparse(reference)
+        if url.scheme == 's3':
+            bucket, key = url.netloc, url.path.lstrip('/')
+        elif url.scheme == 'https' and url.netloc.endswith('.amazonaws.com'):
+            path = unquote(url.path.lstrip('/'))
+            if url.netloc.startswith('s3.') or url.netloc.startswith('s3-'):
+                # Path style: s3.<region>.amazonaws.com/<bucket>/<key>
+                bucket, _, key = path.partition('/')
+            else:
+                # Virtual-hosted style: <bucket>.s3.<region>.amazonaws.com/<key>
+                bucket, key = url.netloc.split('.s3')[0], path
+    if not (isinstance(bucket, str) and isinstance(key, str) and bucket and key):
+        return None
+    return bucket, key
+
+
+def read_object(bucket, key, client=None):
+    _, data_path = fetch_object(bucket, key, client)
+    with open(data_path, 'rb') as f:
+        return f.read()
+
+
+def cached_table_text(bucket, key, filetype, max_input_tokens=None, strategy=None, client=None, table_format=None,
+                      sheets=None):
+    # Serialized table text for an S3 object, parsed once per object version and settings
+    etag, data_path = fetch_object(bucket, key, client)
+    settings = [etag, filetype, max_input_tokens, strategy, table_format or DEFAULT_FORMAT, sheets]
+    variant = hashlib.sha256(json.dumps(settings).encode('utf-8')).hexdigest()[:16]
+    table_path = _base_path(bucket, key) + '.table-' + variant + '.json'
+
+    try:
+        with open(table_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        stats['parse_hits'] += 1
+        return cached['text'], cached['stats']
+    except (OSError, ValueError):
+        pass
+
+    text, table_stats = table_text_for(data_path, filetype, max_input_tokens, strategy, table_format, sheets)
+    stats['parses'] += 1
+    _write_file(table_path, json.dumps({'text': text, 'stats': table_stats}), 'w')
+    return text, table_stats
+
+
+def cached_row_index(bucket, key, filetype, sheet=None, client=None, table_format=None):
+    # Row index for an S3 object, kept in memory and on /tmp per object version
+    etag, data_path = fetch_object(bucket, key, client)
+    table_format = table_format or DEFAULT_FORMAT
+    variant = hashlib.sha256(json.dumps([etag, filetype, sheet, table_format]).encode('utf-8')).hexdigest()[:16]
+    index_path = _base_path(bucket, key) + '.index-' + variant + '.json'
+
+    def build():
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = RowIndex.from_dict(json.load(f))
+            stats['index_hits'] += 1
+            return index
+        except (OSError, ValueError, KeyError):
+            pass
+        index = RowIndex.build(iter_rows(data_path, filetype, sheet), table_format)
+        stats['index_builds'] += 1
+        _write_file(index_path, json.dumps(index.to_dict()), 'w')
+        return index
+
+    return cached_index((bucket, key, etag, filetype, sheet, table_format), build)
@@ -1,19 +1,20 @@
-# Use the Converse API to send a text message to Claude 3 Sonnet.
+# Answer questions about a long document with the Converse API and Claude 3 Sonnet.
+# Only the passages that match each question are sent for quote extraction
+# (see doc_qa.py), so large documents and many questions stay fast and cheap.
 
-import boto3
+from clients import get_client
 from botocore.exceptions import ClientError
+from doc_qa import answer_questions
+from prompt_cache import stats as prompt_cache_stats
 
-# Create a Bedrock Runtime client in the AWS Region you want to use.
-client = boto3.client("bedrock-runtime", region_name="us-east-1")
+# Get the shared Bedrock Runtime client for the AWS Region you want to use.
+client = get_client("bedrock-runtime", region_name="us-east-1")
 
 # Set the model ID, e.g., Titan Text Premier.
 model_id = "anthropic.claude-3-sonnet-20240229-v1:0"
 
-# Start a conversation with the user message.
-user_message = """I'm going to give you a document. Then I'm going to ask you a question about it. I'd like you to first write down exact quotes of parts of the document that would help answer the question, and then I'd like you to answer the question using facts from the quoted content. Here is the document:
-
-<document>
-Anthropic: Challenges in evaluating AI systems
+# The document to answer questions about.
+DOCUMENT = """Anthropic: Challenges in evaluating AI systems
 
 Introduction
 Most conversations around the societal impacts of artificial intelligence (AI) come down to discussing some quality of an AI system, such as its truthfulness, fairness, potential for misuse, and so on. We are able to talk about these characteristics because we can technically evaluate models for their performance in these areas. But what many people working inside and outside of AI don’t fully appreciate is how difficult it is to build robust and reliable model evaluations. Many of today’s existing evaluation suites are limited in their ability to serve as accurate indicators of model capabilities or safety.
@@ -132,50 +133,17 @@ Increase funding for government agencies focused on evaluations, such as the Nat
 Create a legal safe harbor allowing companies to work with governments and third-parties to rigorously evaluate models for national security risks—such as those in the chemical, biological, radiological and nuclear defense (CBRN) domains—without legal repercussions, in the interest of improving safety. This could also include a “responsible disclosure protocol” that enables labs to share sensitive information about identified risks.
 
 Conclusion
-We hope that by openly sharing our experiences evaluating our own systems across many different dimensions, we can help people interested in AI policy acknowledge challenges with current model evaluations.
-</document>
-
-First, find the quotes from the document that are most relevant to answering the question, and then print them in numbered order. Quotes should be relatively short.
-
-If there are no relevant quotes, write "No relevant quotes" instead.
-
-Then, answer the question, starting with "Answer:". Do not include or reference quoted content verbatim in the answer. Don't say "According to Quote [1]" when answering. Instead make references to quotes relevant to each section of the answer solely by adding their bracketed numbers at the end of relevant sentences.
-
-Thus, the format of your overall response should look like what's shown between the <example></example> tags. Make sure to follow the formatting and spacing exactly.
-
-<example>
-Relevant quotes:
-[1] "Company X reported revenue of $12 million in 2021."
-[2] "Almost 90% of revene came from widget sales, with gadget sales making up the remaining 10%."
-
-Answer: 
-Company X earned $12 million. [1]  Almost 90% of it was from widget sales. [2]
-</example>
-
-Here is the first question: In bullet points and simple terms, what are the key challenges in evaluating AI systems?
-
-If the question cannot be answered by the document, say so.
+We hope that by openly sharing our experiences evaluating our own systems across many different dimensions, we can help people interested in AI policy acknowledge challenges with current model evaluations."""
 
-Answer the question immediately without preamble."""
-conversation = [
-    {
-        "role": "user",
-        "content": [{"text": user_message}],
-    }
+# Questions are answered in parallel; each answer lists numbered quotes first.
+QUESTIONS = [
+    "In bullet points and simple terms, what are the key challenges in evaluating AI systems?",
 ]
 
 try:
-    # Send the message to the model, using a basic inference configuration.
-    response = client.converse(
-        modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-        messages=conversation,
-        inferenceConfig={"maxTokens":2000,"temperature":0},
-        additionalModelRequestFields={"top_k":250}
-    )
-
-    # Extract and print the response text.
-    response_text = response["output"]["message"]["content"][0]["text"]
-    print(response_text)
+    for result in answer_questions(client, model_id, DOCUMENT, QUESTIONS):
+        print(result["text"])
+    print("Prompt cache stats:", prompt_cache_stats)
 
 except (ClientError, Exception) as e:
     print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
@@ -0,0 +1,95 @@
+# Text-to-SQL answering for aggregate questions.
+# The model only sees the schema and a few sample rows and writes a query;
+# the query runs locally against an in-memory SQLite copy of the table and
+# the model then phrases the result. Input tokens no longer grow with the
+# number of rows.
+
+import logging
+import re
+import sqlite3
+import time
+
+from response_cache import cached_invoke, message_body, response_text
+
+TABLE_NAME = 'data'
+SAMPLE_ROWS = 5
+MAX_RESULT_ROWS = 50
+
+SQL_INSTRUCTIONS = (
+    "Write one SQLite SELECT query that answers the question using the table described below. "
+    "Quote column names with double quotes. Return only the query inside <sql></sql> tags."
+)
+
+ANSWER_INSTRUCTIONS = (
+    "Answer the question using the SQL result below. The answer should be in three lines. "
+    "Do not provide any code or mention SQL."
+)
+
+
+def load_sqlite(dataframe, table=TABLE_NAME):
+    # In-memory SQLite copy of the DataFrame; usable across Streamlit reruns
+    conn = sqlite3.connect(':memory:', check_same_thread=False)
+    dataframe.to_sql(table, conn, index=False)
+    conn.execute('PRAGMA query_only = ON')
+    return conn
+
+
+def schema_text(conn, dataframe, table=TABLE_NAME, sample_rows=SAMPLE_ROWS):
+    columns = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+    lines = [f'Table "{table}" ({len(dataframe)} rows) with columns:']
+    lines += [f'- "{name}" {col_type or "TEXT"}' for _, name, col_type, _, _, _ in columns]
+    lines.append('Sample rows:')
+    lines.append(dataframe.head(sample_rows).to_csv(index=False).strip())
+    return "\n".join(lines)
+
+
+def extract_sql(text):
+    match = re.search(r'<sql>(.*?)</sql>', text, re.S | re.I)
+    sql = (match.group(1) if match else text).strip().strip('`').strip()
+    if sql.lower().startswith('sql\n'):
+        sql = sql[4:]
+    return sql.rstrip(';').strip()
+
+
+def run_query(conn, sql, max_rows=MAX_RESULT_ROWS):
+    if not re.match(r'^\s*(select|with)\b', sql, re.I):
+        raise ValueError('Only SELECT queries are allowed')
+    cursor = conn.execute(sql)
+    columns = [description[0] for description in cursor.description or []]
+    rows = cursor.fetchmany(max_rows + 1)
+    return columns, rows[:max_rows], len(rows) > max_rows
+
+
+def answer_with_sql(client, model_id, question, conn, dataframe, max_tokens=900):
+    start_time = time.perf_counter()
+    schema = schema_text(conn, dataframe)
+    prompt = f"{SQL_INSTRUCTIONS}\n\n{schema}\n\nQuestion: {question}"
+
+    # Ask for a query; on failure send the error back once so the model can fix it
+    error = None
+    for _ in range(2):
+        text = prompt if error is None else f"{prompt}\n\nThe previous query\n{sql}\nfailed with: {error}"
+        sql = extract_sql(response_text(cached_invoke(client, model_id, message_body(text, 500))))
+        try:
+            columns, rows, truncated = run_query(conn, sql)
+            break
+        except (sqlite3.Error, ValueError) as e:
+            logging.debug(f"SQL failed: {sql} ({e})")
+            error = str(e)
+    else:
+        raise ValueError(f"Could not build a working query: {error}")
+    sql_time = time.perf_counter() - start_time
+
+    result = "\n".join([", ".join(columns)] + [", ".join(map(str, row)) for row in rows])
+    if truncated:
+        result += f"\n... more than {MAX_RESULT_ROWS} rows"
+    text = f"{ANSWER_INSTRUCTIONS}\n\nQuestion: {question}\n\nSQL result:\n{result}"
+    payload = cached_invoke(client, model_id, message_body(text, max_tokens))
+
+    return {
+        'generated_text': response_text(payload),
+        'response': payload,
+        'sql': sql,
+        'sql_result': result,
+        'timings': {'sql_seconds': sql_time, 'total_seconds': time.perf_counter() - start_time},
+    }
@@ -0,0 +1,67 @@
+# Streaming model responses via invoke_model_with_response_stream.
+# ResponseStream yields text deltas as they arrive and records
+# time-to-first-token and total time for the request.
+
+import json
+import logging
+import time
+
+from prompt_cache import prepare_body, record
+from throttling import call_with_retry
+
+
+class ResponseStream:
+
+    def __init__(self, client, model_id, request_body):
+        self.client = client
+        self.model_id = model_id
+        self.request_body = prepare_body(model_id, request_body)
+        self.text = ''
+        self.table_stats = None
+        self.metrics = {
+            'time_to_first_token': None,
+            'total_time': None,
+            'input_tokens': None,
+            'output_tokens': None,
+            'cache_read_input_tokens': None,
+            'cache_write_input_tokens': None,
+            'stop_reason': None,
+        }
+
+    def __iter__(self):
+        start_time = time.perf_counter()
+        response = call_with_retry(lambda: self.client.invoke_model_with_response_stream(
+            modelId=self.model_id,
+            body=json.dumps(self.request_body)
+        ))
+
+        for event in response['body']:
+            chunk = json.loads(event['chunk']['bytes'])
+            chunk_type = chunk.get('type')
+
+            if chunk_type == 'content_block_delta':
+                delta = chunk.get('delta', {}).get('text', '')
+                if not delta:
+                    continue
+                if self.metrics['time_to_first_token'] is None:
+                    self.metrics['time_to_first_token'] = time.perf_counter() - start_time
+                self.text += delta
+                yield delta
+
+            elif chunk_type == 'message_start':
+                message = chunk.get('message', {})
+                self.metrics['input_tokens'] = message.get('usage', {}).get('input_tokens')
+                self.metrics.update(record(message))
+
+            elif chunk_type == 'message_delta':
+                self.metrics['stop_reason'] = chunk.get('delta', {}).get('stop_reason')
+                self.metrics['output_tokens'] = chunk.get('usage', {}).get('output_tokens')
+
+        self.metrics['total_time'] = time.perf_counter() - start_time
+        logging.debug(f"Stream metrics: {self.metrics}")
+
+    def read_all(self):
+        # Drain the stream and return the full text
+        for _ in self:
+            pass
+        return self.text
@@ -0,0 +1,398 @@
+# Token-budget-aware serialization of table rows for prompt construction.
+# Tokens are estimated while the text is built so the request size stays
+# bounded no matter how big the uploaded file is.
+
+import datetime
+import itertools
+import math
+import os
+from collections import Counter, deque
+from decimal import Decimal, InvalidOperation
+
+from ingest import is_excel, iter_rows, iter_xlsx_sheets, resolve_sheets, sheet_inventory
+from tracing import span, timed_rows
+
+# Rough characters-per-token ratio for Claude on tabular text
+CHARS_PER_TOKEN = float(os.environ.get('CHARS_PER_TOKEN', '3.5'))
+
+# Default input-token budget for the table block
+TABLE_TOKEN_BUDGET = int(os.environ.get('TABLE_TOKEN_BUDGET', '20000'))
+
+# Context window of the default model (Claude 3 Sonnet)
+CONTEXT_WINDOW = int(os.environ.get('MODEL_CONTEXT_WINDOW', '200000'))
+
+# truncate: stop at the budget; head_tail: keep the first and last rows;
+# summary: keep the first rows and summarize the rest per column
+STRATEGIES = ('truncate', 'head_tail', 'summary')
+DEFAULT_STRATEGY = os.environ.get('TABLE_STRATEGY', 'head_tail')
+
+# plain: "a, b, c" rows as before; compact: typed, dictionary-encoded rows
+FORMATS = ('plain', 'compact')
+DEFAULT_FORMAT = os.environ.get('TABLE_FORMAT', 'compact')
+
+# Rows used to infer column types and dictionaries for the compact format
+COMPACT_SAMPLE_ROWS = int(os.environ.get('COMPACT_SAMPLE_ROWS', '500'))
+
+# Largest share of the table budget the compact header and code dictionary may use
+COMPACT_DICTIONARY_SHARE = float(os.environ.get('COMPACT_DICTIONARY_SHARE', '0.25'))
+
+# Decimal places kept for non-integral numbers in the compact format; integral
+# values are always written exactly and exponent notation is never used
+COMPACT_FLOAT_DECIMALS = int(os.environ.get('COMPACT_FLOAT_DECIMALS', '6'))
+
+
+def estimate_tokens(text):
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def serialize_row(row):
+    return ", ".join(map(str, row))
+
+
+def input_budget(max_tokens=0, prompt_text='', max_input_tokens=None):
+    # Budget for the table: the configured cap, but never more than what is
+    # left of the context window after the prompt and the answer
+    budget = TABLE_TOKEN_BUDGET if max_input_tokens is None else max_input_tokens
+    remaining = CONTEXT_WINDOW - max_tokens - estimate_tokens(prompt_text)
+    return max(0, min(budget, remaining))
+
+
+def build_table_text(rows, max_input_tokens=None, strategy=None, serialize=serialize_row):
+    budget = TABLE_TOKEN_BUDGET if max_input_tokens is None else max_input_tokens
+    strategy = strategy or DEFAULT_STRATEGY
+    if strategy not in STRATEGIES:
+        raise ValueError(f'Unknown table strategy: {strategy}')
+
+    # Newline joins cost about one token per row. The header (with the compact
+    # code dictionary) is always kept and its tokens come off the row budget
+    head, head_tokens = [], 0
+    head_budget = 0
+    tail, tail_tokens = deque(), 0
+    summary = _ColumnSummary() if strategy == 'summary' else None
+    header, header_line, row_budget = None, None, budget
+    head_open = True
+    rows_total = 0
+    complete = True
+
+    for row in rows:
+        rows_total += 1
+        line = serialize(row)
+        tokens = estimate_tokens(line) + 1
+
+        if header is None:
+            header, header_line = row, line
+            row_budget = max(0, budget - tokens)
+            head_budget = row_budget if strategy == 'truncate' else row_budget // 2
+            continue
+        if head_open and head_tokens + tokens <= head_budget:
+            head.append(line)
+            head_tokens += tokens
+            continue
+        head_open = False
+
+        if strategy == 'truncate':
+            complete = False
+            break
+        if strategy == 'summary':
+            summary.add(row)
+            continue
+
+        # head_tail: keep a rolling window of the most recent rows
+        tail.append((line, tokens))
+        tail_tokens += tokens
+        while tail and tail_tokens > row_budget - head_tokens:
+            tail_tokens -= tail.popleft()[1]
+
+    rows_included = (header is not None) + len(head) + len(tail)
+    omitted = rows_total - rows_included
+    parts = [header_line] if header is not None else []
+    parts.extend(head)
+    if strategy == 'head_tail' and omitted:
+        parts.append(f"... {omitted} rows omitted ...")
+        parts.extend(line for line, _ in tail)
+    elif strategy == 'summary' and omitted:
+        marker = f"... {omitted} more rows, summarized per column:"
+        parts.append(marker)
+        parts.extend(summary.lines(header, row_budget - head_tokens - estimate_tokens(marker) - 1))
+    elif strategy == 'truncate' and not complete:
+        parts.append("... remaining rows omitted ...")
+
+    text = "\n".join(parts)
+    stats = {
+        'strategy': strategy,
+        'budget_tokens': budget,
+        'estimated_tokens': estimate_tokens(text),
+        'rows_included': rows_included,
+        # Unknown when truncation stopped reading early
+        'rows_total': rows_total if complete else None,
+        'truncated': bool(omitted) or not complete,
+    }
+    return text, stats
+
+
+def table_text_for(file_data, filetype, max_input_tokens=None, strategy=None, table_format=None, sheets=None):
+    # sheets selects workbook sheets: None (active sheet), a name, a list of names or "all"
+    if sheets and is_excel(filetype):
+        return sheets_text_for(file_data, max_input_tokens, strategy, table_format, sheets)
+    return rows_text(iter_rows(file_data, filetype), max_input_tokens, strategy, table_format)
+
+
+def rows_text(rows, max_input_tokens=None, strategy=None, table_format=None):
+    # Parsing is lazy, so row fetches are timed as "parse" inside the "serialize" span
+    source = rows
+    with span('serialize'):
+        serialize, rows = row_serializer(timed_rows(rows), table_format, max_input_tokens)
+        text, stats = build_table_text(rows, max_input_tokens, strategy, serialize=serialize)
+    if getattr(source, 'capped', False):
+        # The ingest row or byte cap stopped reading the file
+        text += "\n... remaining rows not read (file size limit) ..."
+        stats.update(estimated_tokens=estimate_tokens(text), rows_total=None, truncated=True)
+    return text, stats
+
+
+def row_serializer(rows, table_format=None, max_input_tokens=None):
+    # (serialize, rows) for a table format; the compact encoder reads a sample of
+    # the rows first, and the returned rows still include them
+    table_format = table_format or DEFAULT_FORMAT
+    if table_format not in FORMATS:
+        raise ValueError(f'Unknown table format: {table_format}')
+    if table_format == 'compact':
+        # The code dictionary may take up to COMPACT_DICTIONARY_SHARE of the budget
+        budget = TABLE_TOKEN_BUDGET if max_input_tokens is None else max_input_tokens
+        return CompactEncoder.from_rows(rows, max_header_tokens=int(budget * COMPACT_DICTIONARY_SHARE))
+    return serialize_row, rows
+
+
+def sheets_text_for(file_data, max_input_tokens=None, strategy=None, table_format=None, sheets='all'):
+    # One section per sheet; sheets are parsed one at a time and share the budget equally
+    budget = TABLE_TOKEN_BUDGET if max_input_tokens is None else max_input_tokens
+    inventory = sheet_inventory(file_data)
+    active = next((sheet['name'] for sheet in inventory if sheet['active']), None)
+    names = resolve_sheets([sheet['name'] for sheet in inventory], active, sheets)
+    sheet_budget = budget // max(1, len(names))
+
+    parts, sheet_stats = [], []
+    for name, rows in iter_xlsx_sheets(file_data, names):
+        text, stats = rows_text(rows, sheet_budget, strategy, table_format)
+        parts.append(f"Sheet {name}:\n{text}")
+        sheet_stats.append(dict(stats, sheet=name))
+
+    text = "\n\n".join(parts)
+    totals = [stats['rows_total'] for stats in sheet_stats]
+    return text, {
+        'strategy': strategy or DEFAULT_STRATEGY,
+        'budget_tokens': budget,
+        'estimated_tokens': estimate_tokens(text),
+        'rows_included': sum(stats['rows_included'] for stats in sheet_stats),
+        'rows_total': None if None in totals else sum(totals),
+        'truncated': any(stats['truncated'] for stats in sheet_stats),
+        'sheets': sheet_stats,
+    }
+
+
+class CompactEncoder:
+    # Stateful row serializer for the compact format:
+    # - the header line carries a type per column (num, date, cat, text)
+    # - empty cells are written as nothing instead of "None"
+    # - float noise beyond COMPACT_FLOAT_DECIMALS places is dropped and dates shortened
+    # - repeated categorical values are replaced by #codes, with the
+    #   dictionary written once under the header (within max_header_tokens)
+    # - "\", "|" and newlines in values are escaped as \\, \| and \n, and a
+    #   literal value starting with "#" as \#, so cells never look like codes
+
+    SEPARATOR = '|'
+
+    def __init__(self, header, types, dictionaries):
+        self.header = header
+        self.types = types
+        self.dictionaries = dictionaries
+        self._header_done = False
+
+    @classmethod
+    def from_rows(cls, rows, sample_size=None, max_header_tokens=None):
+        # Infer types and dictionaries from the first rows; returns the encoder
+        # and an iterator that still yields every row
+        rows = iter(rows)
+        sample = list(itertools.islice(rows, (sample_size or COMPACT_SAMPLE_ROWS) + 1))
+        header = sample[0] if sample else ()
+        body = sample[1:]
+        types, counts = [], []
+        for index in range(len(header)):
+            values = [row[index] for row in body if index < len(row) and not _is_empty(row[index])]
+            column_type = _column_type(values)
+            types.append(column_type)
+            counts.append(Counter(str(value) for value in values) if column_type == 'cat' else Counter())
+        encoder = cls(header, types, [{} for _ in header])
+        encoder.dictionaries = _dictionaries(counts, max_header_tokens, encoder.header_text(), header)
+        return encoder, itertools.chain(sample, rows)
+
+    def __call__(self, row):
+        if not self._header_done:
+            self._header_done = True
+            return self.header_text()
+        return self.SEPARATOR.join(self.cell(index, value) for index, value in enumerate(row))
+
+    def header_text(self):
+        columns = self.SEPARATOR.join(
+            f"{_escape(str(name))}:{self.types[index] if index < len(self.types) else 'text'}"
+            for index, name in enumerate(self.header))
+        lines = [columns]
+        for index, dictionary in enumerate(self.dictionaries):
+            if dictionary:
+                entries = self.SEPARATOR.join(f"{code}={_escape(value)}" for value, code in dictionary.items())
+                lines.append(f"{_escape(str(self.header[index]))} codes: {entries}")
+        return "\n".join(lines)
+
+    def cell(self, index, value):
+        if _is_empty(value):
+            return ''
+        if isinstance(value, float):
+            return _format_number(repr(value))
+        if isinstance(value, datetime.datetime):
+            return value.date().isoformat() if value.time() == datetime.time() else value.isoformat(' ')
+        if isinstance(value, datetime.date):
+            return value.isoformat()
+        text = str(value)
+        if index < len(self.dictionaries):
+            code = self.dictionaries[index].get(text)
+            if code:
+                return code
+        if (index < len(self.types) and self.types[index] == 'num' and _as_number(text) is not None
+                and any(char in text for char in '.eE')):
+            # Fractions and exponents are normalized; integer text (e.g. "007") is kept as written
+            return _format_number(text.strip())
+        return _escape(text)
+
+
+def _escape(text):
+    text = text.replace('\\', '\\\\').replace('|', '\\|').replace('\r\n', '\n').replace('\r', '\n')
+    text = text.replace('\n', '\\n')
+    return '\\' + text if text.startswith('#') else text
+
+
+def _dictionaries(counts, max_header_tokens, header_text, names):
+    # Code dictionaries per column. Values are picked by the characters they save
+    # in the sample, net of their dictionary entry, until the header reaches
+    # max_header_tokens; values left out are written literally
+    candidates = []
+    for index, column_counts in enumerate(counts):
+        for value, count in column_counts.items():
+            entry_chars = len(_escape(value)) + 5
+            saving = count * (len(_escape(value)) - 3) - entry_chars
+            if count >= 2 and saving > 0:
+                candidates.append((saving, entry_chars, index, value))
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    available = None if max_header_tokens is None else max_header_tokens * CHARS_PER_TOKEN - len(header_text)
+    chosen = [set() for _ in counts]
+    for _, entry_chars, index, value in candidates:
+        if available is not None:
+            if not chosen[index]:
+                # First entry of a column also adds its "<name> codes: " line
+                entry_chars += len(_escape(str(names[index]))) + 8
+            if entry_chars > available:
+                continue
+            available -= entry_chars
+        chosen[index].add(value)
+
+    dictionaries = []
+    for index, column_counts in enumerate(counts):
+        dictionary = {}
+        for value, _ in column_counts.most_common():
+            code = f'#{len(dictionary) + 1}'
+            if value in chosen[index] and len(code) < len(value):
+                dictionary[value] = code
+        dictionaries.append(dictionary)
+    return dictionaries
+
+
+def _format_number(text):
+    # Plain decimal text for a number: exact for integral values, rounded to
+    # COMPACT_FLOAT_DECIMALS places otherwise, trailing zeros removed
+    try:
+        number = Decimal(text)
+        if not number.is_finite():
+            return text
+        if number != number.to_integral_value():
+            number = number.quantize(Decimal(1).scaleb(-COMPACT_FLOAT_DECIMALS))
+    except InvalidOperation:
+        return text
+    formatted = f'{number:f}'
+    if '.' in formatted:
+        formatted = formatted.rstrip('0').rstrip('.')
+    return '0' if formatted == '-0' else formatted
+
+
+def _is_empty(value):
+    return value is None or value == ''
+
+
+def _column_type(values):
+    if not values:
+        return 'text'
+    if all(isinstance(value, (datetime.date, datetime.datetime)) for value in values):
+        return 'date'
+    if all(_as_number(value) is not None for value in values):
+        return 'num'
+    distinct = len(set(map(str, values)))
+    if distinct <= max(1, len(values) // 2):
+        return 'cat'
+    return 'text'
+
+
+class _ColumnSummary:
+    # Running per-column count/min/max/mean and a few example values
+
+    MAX_EXAMPLES = 5
+
+    def __init__(self):
+        self.count = 0
+        self.columns = {}
+
+    def add(self, row):
+        self.count += 1
+        for index, value in enumerate(row):
+            if value is None or value == '':
+                continue
+            column = self.columns.setdefault(index, {
+                'filled': 0, 'numeric': 0, 'sum': 0.0, 'min': None, 'max': None, 'examples': [],
+            })
+            column['filled'] += 1
+            number = _as_number(value)
+            if number is not None:
+                column['numeric'] += 1
+                column['sum'] += number
+                column['min'] = number if column['min'] is None else min(column['min'], number)
+                column['max'] = number if column['max'] is None else max(column['max'], number)
+            elif len(column['examples']) < self.MAX_EXAMPLES and value not in column['examples']:
+                column['examples'].append(value)
+
+    def lines(self, header, budget=None):
+        # One line per column, stopping at the token budget
+        lines, tokens = [], 0
+        for index in sorted(self.columns):
+            column = self.columns[index]
+            name = header[index] if header and index < len(header) else f'column {index + 1}'
+            text = f"{name}: {column['filled']}/{self.count} filled"
+            if column['numeric']:
+                mean = column['sum'] / column['numeric']
+                text += f", min {column['min']:g}, max {column['max']:g}, mean {mean:.4g}"
+            if column['examples']:
+                text += ", e.g. " + "; ".join(map(str, column['examples']))
+            line_tokens = estimate_tokens(text) + 1
+            if budget is not None and tokens + line_tokens > budget:
+                break
+            lines.append(text)
+            tokens += line_tokens
+        return lines
+
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
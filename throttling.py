@@ -0,0 +1,106 @@
+# Throttling-aware call wrapper for Bedrock.
+# Retries throttled and transient errors with jittered exponential backoff
+# and adapts the number of in-flight calls AIMD style: the window shrinks
+# multiplicatively on throttles and grows back additively on success.
+
+import logging
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+THROTTLE_CODES = ('ThrottlingException', 'TooManyRequestsException', 'Throttling')
+TRANSIENT_CODES = ('ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException')
+
+MAX_ATTEMPTS = int(os.environ.get('BEDROCK_MAX_ATTEMPTS', '6'))
+BASE_DELAY = float(os.environ.get('BEDROCK_BACKOFF_BASE', '0.25'))
+MAX_DELAY = float(os.environ.get('BEDROCK_BACKOFF_MAX', '20'))
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', '')
+    return ''
+
+
+class AdaptiveConcurrency:
+
+    def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        self.stats = {'calls': 0, 'retries': 0, 'throttles': 0, 'backoff_seconds': 0.0, 'queue_seconds': 0.0}
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        start_time = time.perf_counter()
+        with self._condition:
+            while self.in_flight >= max(self.minimum, int(self.limit)):
+                self._condition.wait()
+            self.in_flight += 1
+            self.stats['queue_seconds'] += time.perf_counter() - start_time
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                # About +1 per full window of successful calls
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def record(self, **increments):
+        with self._condition:
+            for name, value in increments.items():
+                self.stats[name] += value
+
+    def snapshot(self):
+        with self._condition:
+            return dict(self.stats, limit=self.limit, in_flight=self.in_flight)
+
+
+# Process-wide window shared by every Bedrock call
+default_concurrency = AdaptiveConcurrency(
+    initial=int(os.environ.get('BEDROCK_INITIAL_CONCURRENCY', '4')),
+    maximum=int(os.environ.get('BEDROCK_MAX_CONCURRENCY', '32')),
+)
+
+
+def call_with_retry(func, concurrency=None, max_attempts=None, base_delay=None, max_delay=None):
+    # Run func() inside the adaptive window, retrying throttles and transient errors
+    concurrency = concurrency or default_concurrency
+    max_attempts = max_attempts or MAX_ATTEMPTS
+    base_delay = BASE_DELAY if base_delay is None else base_delay
+    max_delay = MAX_DELAY if max_delay is None else max_delay
+
+    for attempt in range(max_attempts):
+        concurrency.acquire()
+        try:
+            result = func()
+        except ClientError as e:
+            code = error_code(e)
+            throttled = code in THROTTLE_CODES
+            concurrency.release(throttled=throttled)
+            if throttled:
+                concurrency.record(throttles=1)
+            if not (throttled or code in TRANSIENT_CODES) or attempt == max_attempts - 1:
+                raise
+
+            # Full jitter: sleep a random time up to the exponential cap
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            concurrency.record(retries=1, backoff_seconds=delay)
+            logging.debug(f"{code}, retrying in {delay:.2f}s (attempt {attempt + 1}/{max_attempts})")
+            time.sleep(delay)
+            continue
+        except Exception:
+            concurrency.release()
+            raise
+
+        concurrency.release()
+        concurrency.record(calls=1)
+        return result
@@ -0,0 +1,182 @@
+# Per-stage latency spans for handlers and process_event.
+# A request collects the time spent in each stage (S3 fetch, decode, parse,
+# serialize, model invoke, ...) and emits one structured record at the end,
+# by default as a CloudWatch Embedded Metric Format (EMF) JSON line. With no
+# sink configured, span() returns a shared no-op context manager and the
+# row iterators are passed through untouched, so the cost is one check.
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+# Sink for finished requests: "emf" (JSON lines on stdout), "log" (logging.info) or unset
+SINK = os.environ.get('TRACE_SINK', '').lower()
+NAMESPACE = os.environ.get('TRACE_NAMESPACE', 'BedrockTableQA')
+
+_NULL_SPAN = nullcontext()
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def emf_sink(record):
+    # One CloudWatch EMF line; stage durations become metrics with the request name as dimension
+    stages = record['stages']
+    document = {
+        '_aws': {
+            'Timestamp': int(record['timestamp'] * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [['Request']],
+                'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in ['total'] + list(stages)],
+            }],
+        },
+        'Request': record['name'],
+        'total': record['total_ms'],
+    }
+    document.update(stages)
+    document.update(record['properties'])
+    sys.stdout.write(json.dumps(document) + '\n')
+    sys.stdout.flush()
+
+
+def log_sink(record):
+    logging.info(f"Trace: {json.dumps(record)}")
+
+
+SINKS = {'emf': emf_sink, 'log': log_sink}
+_sink = SINKS.get(SINK)
+
+
+def set_sink(sink):
+    # Use a named sink, a callable taking the record dict, or None to disable tracing
+    global _sink
+    _sink = SINKS[sink] if isinstance(sink, str) else sink
+
+
+def enabled():
+    return _sink is not None
+
+
+class _Trace:
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}  # stage -> exclusive milliseconds
+        self.properties = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def stack(self):
+        # Child time (seconds) of each open span, per thread: spans in executor
+        # workers (see bind) overlap the caller's, so they are not nested in them
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds * 1000
+        if self.stack:
+            self.stack[-1] += seconds
+
+
+class _Span:
+
+    def __init__(self, trace, stage):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.trace.stack.append(0.0)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start_time
+        child = self.trace.stack.pop()
+        # Nested spans are reported on their own, so the parent keeps only its own time
+        self.trace.add(self.stage, elapsed - child)
+        if self.trace.stack:
+            self.trace.stack[-1] += child
+        return False
+
+
+def span(stage):
+    trace = _current.get() if _sink is not None else None
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, stage)
+
+
+def timed_rows(rows, stage='parse'):
+    # Charge the time spent producing each row to stage (the streaming parsers are lazy)
+    trace = _current.get() if _sink is not None else None
+    if trace is None:
+        return rows
+
+    def generate():
+        iterator = iter(rows)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                row = next(iterator)
+            except StopIteration:
+                trace.add(stage, time.perf_counter() - start_time)
+                return
+            trace.add(stage, time.perf_counter() - start_time)
+            yield row
+
+    return generate()
+
+
+def set_property(name, value):
+    # Extra field on the emitted record (e.g. file type, strategy)
+    trace = _current.get()
+    if trace is not None:
+        trace.properties[name] = value
+
+
+def bind(func):
+    # func run in a copy of the caller's context, for executor tasks: worker threads
+    # start with an empty context, so their spans would not reach the request trace.
+    # Each call gets its own copy, since one context cannot be entered by two threads
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def traced(name):
+    # Decorator: trace each call of a handler and emit its record when it returns
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None or _current.get() is not None:
+                return func(*args, **kwargs)
+            trace = _Trace(name)
+            token = _current.set(trace)
+            start_time = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current.reset(token)
+                record = {
+                    'name': name,
+                    'timestamp': time.time(),
+                    'total_ms': (time.perf_counter() - start_time) * 1000,
+                    'stages': {stage: round(ms, 3) for stage, ms in trace.stages.items()},
+                    'properties': trace.properties,
+                }
+                try:
+                    _sink(record)
+                except Exception as e:
+                    logging.error(f"Trace sink failed: {e}")
+        return wrapper
+    return decorator